@@ -1,16 +1,77 @@
 from fastapi import FastAPI, Request, Depends, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi.responses import RedirectResponse, Response
+from starlette.datastructures import Headers
+from starlette.types import Scope
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from .routers import telemetry, auth
 # Removed old rate limiting middleware - now using database-driven system
-from .middleware.request_protection import RequestProtectionMiddleware
-from .middleware.ip_blocking import IPBlockingMiddleware
+from .middleware.ip_blocking import IPBlockingMiddleware, flush_blocked_ips
 from .middleware.security_logging_middleware import SecurityLoggingMiddleware
+from .middleware.client_ip import client_ip_from_scope
+from .services.ip_brutal_tracker import ip_brutal_tracker
+from .services.background_logger import flush_api_request_logs, api_request_log_table_exists
+from .services.security_monitor import security_log_listener
+from .services.db_access_control import flush_usage_stats
 from datetime import datetime
+from email.utils import formatdate
+from typing import Dict, Optional, Tuple
+import asyncio
+import hashlib
+import mimetypes
 import os
+import posixpath
 from pathlib import Path
 
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves a small, immutable bundle from memory.
+    Files are read once at startup; responses carry ETag/Last-Modified and
+    revalidation with If-None-Match returns 304 without touching the disk.
+    """
+
+    def __init__(self, *, directory: str, html: bool = False, max_age: int = 86400):
+        super().__init__(directory=directory, html=html)
+        self.cache_control = f"public, max-age={max_age}"
+        # {relative_path: (content, etag, last_modified, media_type)}
+        self._files: Dict[str, Tuple[bytes, str, str, str]] = {}
+        for file_path in Path(directory).rglob("*"):
+            if file_path.is_file():
+                data = file_path.read_bytes()
+                self._files[file_path.relative_to(directory).as_posix()] = (
+                    data,
+                    f'"{hashlib.sha1(data).hexdigest()}"',
+                    formatdate(file_path.stat().st_mtime, usegmt=True),
+                    mimetypes.guess_type(file_path.name)[0] or "application/octet-stream",
+                )
+
+    def cached_response(self, key: str, scope: Scope) -> Optional[Response]:
+        """Build a response for a cached file (None if the file is not cached)"""
+        entry = self._files.get(key)
+        if entry is None:
+            return None
+
+        content, etag, last_modified, media_type = entry
+        headers = {"etag": etag, "last-modified": last_modified, "cache-control": self.cache_control}
+        if Headers(scope=scope).get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=content, media_type=media_type, headers=headers)
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        response = None
+        if scope["method"] in ("GET", "HEAD"):
+            key = "" if path == "." else path.replace(os.sep, "/")
+            response = self.cached_response(key, scope)
+            if response is None and self.html and (key == "" or scope["path"].endswith("/")):
+                response = self.cached_response(posixpath.join(key, "index.html"), scope)
+        if response is None:
+            # Unknown path or method - let StaticFiles handle redirects, 404s and 405s
+            return await super().get_response(path, scope)
+        return response
+
+
 # Disable docs in production for security
 app = FastAPI(
     title="Direct Link API", 
@@ -25,18 +86,15 @@ app = FastAPI(
 # 1. Security logging middleware (outermost - logs everything)
 app.add_middleware(SecurityLoggingMiddleware)
 
-# 2. IP and API Key blocking (first line of defense)
-app.add_middleware(IPBlockingMiddleware)
-
-# 3. Request protection (size, timeout, concurrent requests)
+# 2. IP and API Key blocking + request protection (size, timeout, concurrent requests)
 app.add_middleware(
-    RequestProtectionMiddleware,
+    IPBlockingMiddleware,
     max_request_size=1024 * 1024,  # 1MB max request size
     request_timeout=30.0,          # 30 second timeout
     max_concurrent_requests=100    # Max 100 concurrent requests
 )
 
-# 4. CORS (be more restrictive in production)
+# 3. CORS (be more restrictive in production)
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "*").split(",")
 app.add_middleware(
     CORSMiddleware,
@@ -46,21 +104,42 @@ app.add_middleware(
     allow_credentials=False,
 )
 
+# 4. Response compression (JSON/CSV query results are highly repetitive; small responses are left as-is)
+app.add_middleware(GZipMiddleware, minimum_size=2048, compresslevel=5)
+
 app.include_router(telemetry.router)
 app.include_router(auth.router)
 
+@app.on_event("startup")
+async def check_request_log_table():
+    """Resolve the api_request_log existence check once, before any request is logged"""
+    try:
+        await asyncio.to_thread(api_request_log_table_exists)
+    except Exception as e:
+        # Database not reachable yet - the first logged batch will check instead
+        print(f"Warning: Could not check app.api_request_log table: {e}")
+
+@app.on_event("shutdown")
+async def flush_request_logs():
+    """Write out API request logs, usage counts and block-list saves still waiting in the background"""
+    await flush_api_request_logs()
+    await flush_usage_stats()
+    await flush_blocked_ips()
+    # Drains queued security log records and stops the listener thread
+    security_log_listener.stop()
+
 # Serve API manual at /api_doc (with error handling for production)
 try:
-    public_dir = Path(__file__).resolve().parent / "public"
-    if public_dir.exists() and (public_dir / "index.html").exists():
-        # Mount assets and directory browsing under /api_doc/*
-        app.mount("/api_doc", StaticFiles(directory=str(public_dir), html=True), name="api_doc")
+    public_dir = Path(__file__).parent / "public"
+    if (public_dir / "index.html").is_file():
+        # Mount assets and directory browsing under /api_doc/* (files are loaded into memory once)
+        api_doc_files = CachedStaticFiles(directory=str(public_dir), html=True)
+        app.mount("/api_doc", api_doc_files, name="api_doc")
 
-        # Ensure /api_doc (exact) serves the index.html
+        # Ensure /api_doc (exact) serves the index.html from the same in-memory cache
         @app.get("/api_doc", include_in_schema=False)
-        async def api_doc_index():
-            index_path = public_dir / "index.html"
-            return FileResponse(str(index_path), media_type="text/html")
+        async def api_doc_index(request: Request):
+            return api_doc_files.cached_response("index.html", request.scope)
     else:
         # Fallback if public directory doesn't exist
         @app.get("/api_doc", include_in_schema=False)
@@ -70,15 +149,14 @@ except Exception as e:
     # Don't let static file mounting break the entire app
     pass
 
+# Pre-encoded body for the common (not blocked) health check response
+_HEALTHZ_OK_BYTES = b'{"ok":true}'
+
 @app.get("/healthz")
 def healthz(request: Request):
     """Health check endpoint with brutal attack protection"""
-    # Import here to avoid circular imports
-    from .services.ip_brutal_tracker import ip_brutal_tracker
-    
-    # Get client IP
-    client_ip = request.headers.get("x-forwarded-for", 
-                                  request.client.host if request.client else "unknown")
+    # Get client IP (resolved once per request by the security logging middleware)
+    client_ip = client_ip_from_scope(request.scope)
     
     # Track IP for brutal attack detection
     is_ip_blocked = ip_brutal_tracker.track_ip_request(client_ip)
@@ -95,4 +173,4 @@ def healthz(request: Request):
             "timestamp": datetime.now().isoformat()
         }
     
-    return {"ok": True}
+    return Response(content=_HEALTHZ_OK_BYTES, media_type="application/json")
@@ -0,0 +1,42 @@
+"""
+Client IP resolution shared by the middlewares and request handlers
+"""
+from starlette.types import Scope
+
+# Raw ASGI header names (lower-case bytes) read by client_ip_from_scope
+_XFF = b"x-forwarded-for"
+_X_REAL_IP = b"x-real-ip"
+
+def client_ip_from_scope(scope: Scope) -> str:
+    """
+    Get the client IP for a request, computed once and cached on request.state (scope["state"]).
+    The first X-Forwarded-For header wins (first hop only), then the first X-Real-IP, then the
+    direct connection address. Header values are decoded as latin-1, like Starlette's Headers.
+    """
+    state = scope.setdefault("state", {})
+    client_ip = state.get("client_ip")
+    if client_ip is not None:
+        return client_ip
+    
+    # Scan the raw ASGI headers directly rather than building a Starlette Headers object
+    forwarded_for = real_ip = None
+    for name, value in scope["headers"]:
+        if name == _XFF:
+            forwarded_for = value
+            break
+        if name == _X_REAL_IP and real_ip is None:
+            real_ip = value
+    
+    if forwarded_for:
+        # Check for forwarded IP (from load balancer/proxy) - first hop only
+        client_ip = forwarded_for.decode("latin-1").split(",", 1)[0].strip()
+    elif real_ip:
+        # Check other common headers
+        client_ip = real_ip.decode("latin-1").strip()
+    else:
+        # Fall back to direct connection IP
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+    
+    state["client_ip"] = client_ip
+    return client_ip
@@ -1,24 +1,115 @@
 """
-IP blocking and suspicious activity detection
+IP blocking, suspicious activity detection and request protection
 """
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
-from typing import Set, Dict, List
+from starlette.datastructures import QueryParams
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Dict, List, Optional
+from collections import deque, OrderedDict
+from functools import lru_cache
+from bisect import bisect_right
+import socket
+import struct
 import time
-from datetime import datetime, timedelta
+import asyncio
+from datetime import datetime
 import ipaddress
+import hashlib
 import json
 import os
+import weakref
+from .client_ip import client_ip_from_scope
 
-class IPBlockingMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
-        self.blocked_ips: Set[str] = set()
-        self.blocked_api_keys: Set[str] = set()  # Track blocked API keys
+# Debug-only X-Client-IP / X-API-Key-Tracked response headers (same data is in the security log)
+_DEBUG_HEADERS = os.getenv("DEBUG_HEADERS", "").lower() in ("1", "true", "yes")
+
+# Localhost/development addresses are never tracked or auto-banned
+_DEV_IPS = frozenset({'127.0.0.1', '::1', 'localhost', 'unknown'})
+
+# Live middleware instances, so shutdown can flush their debounced block-list saves
+# (Starlette builds the instance itself, so the app has no direct reference to it)
+_instances: "weakref.WeakSet[IPBlockingMiddleware]" = weakref.WeakSet()
+
+def _content_length(scope: Scope) -> Optional[bytes]:
+    """Raw Content-Length header value, read straight from the ASGI headers (no Headers object)"""
+    for name, value in scope["headers"]:
+        if name == b"content-length":
+            return value
+    return None
+
+def _api_key_hash(api_key: str) -> int:
+    """64-bit digest of an API key, so block lists and abuse tracking never hold the raw key"""
+    return int.from_bytes(hashlib.blake2b(api_key.encode("utf-8"), digest_size=8).digest(), "big")
+
+def _ipv4_int(ip: str) -> Optional[int]:
+    """Parse a dotted-quad IPv4 address to an int in C (no ipaddress object); None if not IPv4"""
+    try:
+        return struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+    except OSError:
+        return None
+
+def _count_since(timestamps: deque, cutoff: float) -> int:
+    """Count timestamps newer than cutoff, walking back from the newest (deques are time-ordered)"""
+    count = 0
+    for ts in reversed(timestamps):
+        if ts <= cutoff:
+            break
+        count += 1
+    return count
+
+def _load_api_key_hash(value: str) -> int:
+    """Parse a persisted API key hash (16 hex chars); legacy entries holding the raw key are hashed"""
+    if len(value) == 16:
+        try:
+            return int(value, 16)
+        except ValueError:
+            pass
+    return _api_key_hash(value)
+
+class IPBlockingMiddleware:
+    """
+    Pure ASGI middleware combining IP/API key blocking with request protection
+    (request size, timeout and concurrent request limits)
+    """
+    
+    def __init__(
+        self,
+        app: ASGIApp,
+        max_request_size: int = 1024 * 1024,  # 1MB
+        request_timeout: float = 30.0,  # 30 seconds
+        max_concurrent_requests: int = 100
+    ):
+        self.app = app
+        self.max_request_size = max_request_size
+        self.request_timeout = request_timeout
+        self.max_concurrent_requests = max_concurrent_requests
+        self._concurrency = asyncio.BoundedSemaphore(max_concurrent_requests)
+        
+        # Blocked IPs/API keys in insertion order (value: time.monotonic() when blocked), capped at
+        # max_blocked_entries by evicting the oldest. Hot-path reads go through the frozenset views,
+        # which are rebound (never mutated) whenever the underlying dicts change.
+        self.max_blocked_entries = 10000
+        self.blocked_ips: "OrderedDict[str, float]" = OrderedDict()
+        self.blocked_api_keys: "OrderedDict[int, float]" = OrderedDict()  # Track blocked API keys (by _api_key_hash)
+        self._blocked_ips_view: frozenset = frozenset()
+        self._blocked_api_keys_view: frozenset = frozenset()
         self.suspicious_activity: Dict[str, Dict] = {}
-        self.api_key_abuse: Dict[str, Dict] = {}  # Track abuse by API key
+        self.api_key_abuse: Dict[int, Dict] = {}  # Track abuse by API key (by _api_key_hash)
         self.blocked_ranges: List[ipaddress.IPv4Network] = []
         
+        # Blocked ranges compiled to sorted, non-overlapping integer intervals
+        self._range_starts: List[int] = []
+        self._range_ends: List[int] = []
+        
+        # Per-instance memo of range lookups, keyed by the raw IP string
+        self._ip_in_blocked_ranges = lru_cache(maxsize=4096)(self._scan_blocked_ranges)
+        
+        # Debounced background persistence of the block list (writer starts on first dispatch)
+        self.save_debounce_seconds = 2.0
+        self._dirty = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+        _instances.add(self)
+        
         # Load blocked IPs from file if exists
         self.load_blocked_ips()
         
@@ -34,8 +125,10 @@ class IPBlockingMiddleware(BaseHTTPMiddleware):
             try:
                 with open(blocked_file, 'r') as f:
                     data = json.load(f)
-                    self.blocked_ips = set(data.get('ips', []))
-                    self.blocked_api_keys = set(data.get('api_keys', []))  # Load blocked API keys
+                    now = time.monotonic()
+                    self.blocked_ips = self._cap_blocked(OrderedDict.fromkeys(data.get('ips', []), now))
+                    self.blocked_api_keys = self._cap_blocked(OrderedDict.fromkeys(
+                        (_load_api_key_hash(k) for k in data.get('api_keys', [])), now))  # Load blocked API keys
                     
                     # Load blocked IP ranges
                     for range_str in data.get('ranges', []):
@@ -45,192 +138,219 @@ class IPBlockingMiddleware(BaseHTTPMiddleware):
                             pass
             except Exception as e:
                 print(f"Error loading blocked IPs: {e}")
+        
+        self._blocked_ips_view = frozenset(self.blocked_ips)
+        self._blocked_api_keys_view = frozenset(self.blocked_api_keys)
+        self._compile_blocked_ranges()
+    
+    def _cap_blocked(self, blocked: OrderedDict) -> OrderedDict:
+        """Evict the oldest entries so a block list never exceeds max_blocked_entries"""
+        while len(blocked) > self.max_blocked_entries:
+            blocked.popitem(last=False)
+        return blocked
+    
+    def block_ip(self, ip: str):
+        """Add an IP to the block list, rebind the read-only view and schedule a save"""
+        self.blocked_ips[ip] = time.monotonic()
+        self._cap_blocked(self.blocked_ips)
+        self._blocked_ips_view = frozenset(self.blocked_ips)
+        self.save_blocked_ips()
+    
+    def block_api_key(self, key_hash: int):
+        """Add an API key hash to the block list, rebind the read-only view and schedule a save"""
+        self.blocked_api_keys[key_hash] = time.monotonic()
+        self._cap_blocked(self.blocked_api_keys)
+        self._blocked_api_keys_view = frozenset(self.blocked_api_keys)
+        self.save_blocked_ips()
+    
+    def _compile_blocked_ranges(self):
+        """Convert blocked ranges into sorted (start, end) integer intervals for bisect lookups"""
+        intervals = sorted(
+            (int(network.network_address), int(network.broadcast_address))
+            for network in self.blocked_ranges
+        )
+        
+        starts: List[int] = []
+        ends: List[int] = []
+        for start, end in intervals:
+            # Merge overlapping/adjacent ranges so each IP maps to at most one interval
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        
+        self._range_starts = starts
+        self._range_ends = ends
+        self._ip_in_blocked_ranges.cache_clear()
     
     def save_blocked_ips(self):
-        """Save blocked IPs and API keys to configuration file"""
+        """Schedule blocked IPs and API keys to be saved to the configuration file"""
+        if self._writer_task is None:
+            # No background writer yet (not serving requests) - write immediately
+            self._write_blocked_ips(self._serialize_blocked_ips())
+            return
+        self._dirty.set()
+    
+    def _serialize_blocked_ips(self) -> str:
+        """Snapshot the block list as JSON (runs on the event loop, before handing off to a thread)"""
+        return json.dumps({
+            'ips': list(self.blocked_ips),
+            'api_keys': [f'{key_hash:016x}' for key_hash in self.blocked_api_keys],  # Save blocked API key hashes
+            'ranges': [str(r) for r in self.blocked_ranges],
+            'updated': datetime.now().isoformat()
+        }, separators=(',', ':'))
+    
+    def _write_blocked_ips(self, payload: str):
+        """Write a serialized block list to the configuration file"""
         blocked_file = "blocked_ips.json"
         try:
             with open(blocked_file, 'w') as f:
-                json.dump({
-                    'ips': list(self.blocked_ips),
-                    'api_keys': list(self.blocked_api_keys),  # Save blocked API keys
-                    'ranges': [str(r) for r in self.blocked_ranges],
-                    'updated': datetime.now().isoformat()
-                }, f, indent=2)
+                f.write(payload)
         except Exception as e:
             print(f"Error saving blocked IPs: {e}")
     
-    def get_client_ip(self, request: Request) -> str:
-        """Extract client IP from request headers"""
-        # Check for forwarded IP (from load balancer/proxy)
-        forwarded_for = request.headers.get("x-forwarded-for")
-        if forwarded_for:
-            return forwarded_for.split(",")[0].strip()
-        
-        # Check other common headers
-        real_ip = request.headers.get("x-real-ip")
-        if real_ip:
-            return real_ip
-        
-        # Fallback to direct connection IP
-        return request.client.host if request.client else "unknown"
+    async def _blocked_ips_writer(self):
+        """Background task that coalesces save requests into at most one write per debounce interval"""
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self.save_debounce_seconds)
+            self._dirty.clear()
+            await asyncio.to_thread(self._write_blocked_ips, self._serialize_blocked_ips())
+    
+    async def flush_blocked_ips(self):
+        """Stop the background writer and write out a save it was still debouncing"""
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None  # Later saves write immediately
+        if self._dirty.is_set():
+            self._dirty.clear()
+            await asyncio.to_thread(self._write_blocked_ips, self._serialize_blocked_ips())
     
     def is_ip_blocked(self, ip: str) -> bool:
         """Check if IP is blocked"""
-        if ip in self.blocked_ips:
+        if ip in self._blocked_ips_view:
             return True
         
         # Check if IP is in any blocked range
-        try:
-            ip_obj = ipaddress.IPv4Address(ip)
-            for network in self.blocked_ranges:
-                if ip_obj in network:
-                    return True
-        except:
-            pass
+        if not self._range_starts:
+            return False
+        return self._ip_in_blocked_ranges(ip)
+    
+    def _scan_blocked_ranges(self, ip: str) -> bool:
+        """Scan blocked ranges for an IP (memoized via _ip_in_blocked_ranges)"""
+        # Blocked ranges are IPv4 only; IPv6 and malformed addresses never match
+        ip_int = _ipv4_int(ip)
+        if ip_int is None:
+            return False
         
-        return False
+        idx = bisect_right(self._range_starts, ip_int) - 1
+        return idx >= 0 and ip_int <= self._range_ends[idx]
     
     def is_api_key_blocked(self, api_key: str) -> bool:
         """Check if API key is blocked"""
-        return api_key in self.blocked_api_keys
+        if len(api_key) < 8 or not self._blocked_api_keys_view:
+            return False
+        return _api_key_hash(api_key) in self._blocked_api_keys_view
+    
+    def _new_activity(self) -> Dict:
+        """Create an empty activity record (timestamps are time.monotonic() floats)"""
+        return {
+            'requests': deque(),
+            'failed_auth': deque(),
+            'first_seen': datetime.now().isoformat()
+        }
     
-    def track_api_key_activity(self, api_key: str, activity_type: str):
+    def _record_activity(self, activity: Dict, activity_type: str, now: float):
+        """Append a timestamp and evict entries that fell out of the tracking window"""
+        if activity_type == 'request':
+            timestamps = activity['requests']
+            cutoff = now - 3600  # Keep only last hour of requests
+        elif activity_type == 'failed_auth':
+            timestamps = activity['failed_auth']
+            cutoff = now - 86400  # Keep only last day of failed auth attempts
+        else:
+            return
+        
+        timestamps.append(now)
+        while timestamps and timestamps[0] < cutoff:
+            timestamps.popleft()
+    
+    def track_api_key_activity(self, api_key: str, activity_type: str, key_hash: Optional[int] = None):
         """Track suspicious activity for an API key"""
         if not api_key or len(api_key) < 8:
             return
+        if key_hash is None:
+            key_hash = _api_key_hash(api_key)
             
-        now = datetime.now()
-        
-        if api_key not in self.api_key_abuse:
-            self.api_key_abuse[api_key] = {
-                'requests': [],
-                'failed_auth': [],
-                'first_seen': now.isoformat()
-            }
-        
-        activity = self.api_key_abuse[api_key]
-        
-        if activity_type == 'request':
-            activity['requests'].append(now.isoformat())
-            # Keep only last hour of requests
-            cutoff = now - timedelta(hours=1)
-            activity['requests'] = [
-                req for req in activity['requests'] 
-                if datetime.fromisoformat(req) > cutoff
-            ]
+        activity = self.api_key_abuse.get(key_hash)
+        if activity is None:
+            activity = self.api_key_abuse[key_hash] = self._new_activity()
         
-        elif activity_type == 'failed_auth':
-            activity['failed_auth'].append(now.isoformat())
-            # Keep only last day of failed auth attempts
-            cutoff = now - timedelta(days=1)
-            activity['failed_auth'] = [
-                attempt for attempt in activity['failed_auth']
-                if datetime.fromisoformat(attempt) > cutoff
-            ]
+        self._record_activity(activity, activity_type, time.monotonic())
         
         # Check if we should auto-ban this API key
-        self.check_api_key_auto_ban(api_key, activity)
+        self.check_api_key_auto_ban(api_key, activity, key_hash)
     
     def track_suspicious_activity(self, ip: str, activity_type: str):
         """Track suspicious activity for an IP"""
-        now = datetime.now()
-        
-        if ip not in self.suspicious_activity:
-            self.suspicious_activity[ip] = {
-                'requests': [],
-                'failed_auth': [],
-                'first_seen': now.isoformat()
-            }
-        
-        activity = self.suspicious_activity[ip]
+        activity = self.suspicious_activity.get(ip)
+        if activity is None:
+            activity = self.suspicious_activity[ip] = self._new_activity()
         
-        if activity_type == 'request':
-            activity['requests'].append(now.isoformat())
-            # Keep only last hour of requests
-            cutoff = now - timedelta(hours=1)
-            activity['requests'] = [
-                req for req in activity['requests'] 
-                if datetime.fromisoformat(req) > cutoff
-            ]
-        
-        elif activity_type == 'failed_auth':
-            activity['failed_auth'].append(now.isoformat())
-            # Keep only last day of failed auth attempts
-            cutoff = now - timedelta(days=1)
-            activity['failed_auth'] = [
-                attempt for attempt in activity['failed_auth']
-                if datetime.fromisoformat(attempt) > cutoff
-            ]
+        self._record_activity(activity, activity_type, time.monotonic())
         
         # Check if we should auto-ban this IP
         self.check_auto_ban(ip, activity)
     
     def check_auto_ban(self, ip: str, activity: Dict):
         """Check if IP should be automatically banned"""
-        now = datetime.now()
-        minute_ago = now - timedelta(minutes=1)
+        minute_ago = time.monotonic() - 60
         
         # Count recent requests
-        recent_requests = len([
-            req for req in activity.get('requests', [])
-            if datetime.fromisoformat(req) > minute_ago
-        ])
+        recent_requests = _count_since(activity['requests'], minute_ago)
         
         # Count recent failed auth attempts
-        recent_failed_auth = len([
-            attempt for attempt in activity.get('failed_auth', [])
-            if datetime.fromisoformat(attempt) > minute_ago
-        ])
+        recent_failed_auth = _count_since(activity['failed_auth'], minute_ago)
         
         # Auto-ban conditions
         should_ban = (
             recent_requests > self.max_requests_per_minute or
             recent_failed_auth > self.max_failed_auth_attempts or
-            len(activity.get('failed_auth', [])) > 50  # Too many failed attempts overall
+            len(activity['failed_auth']) > 50  # Too many failed attempts overall
         )
         
         # Don't auto-ban localhost/development IPs
-        development_ips = {'127.0.0.1', '::1', 'localhost'}
-        if ip in development_ips:
+        if ip in _DEV_IPS:
             if should_ban:
                 print(f"WARNING: Would auto-ban development IP {ip}, but skipping for development")
             return
         
-        if should_ban and ip not in self.blocked_ips:
+        if should_ban and ip not in self._blocked_ips_view:
             print(f"Auto-banning IP {ip} due to suspicious activity")
-            self.blocked_ips.add(ip)
-            self.save_blocked_ips()
+            self.block_ip(ip)
     
-    def check_api_key_auto_ban(self, api_key: str, activity: Dict):
+    def check_api_key_auto_ban(self, api_key: str, activity: Dict, key_hash: int):
         """Check if API key should be automatically banned"""
-        now = datetime.now()
-        minute_ago = now - timedelta(minutes=1)
+        minute_ago = time.monotonic() - 60
         
         # Count recent requests
-        recent_requests = len([
-            req for req in activity.get('requests', [])
-            if datetime.fromisoformat(req) > minute_ago
-        ])
+        recent_requests = _count_since(activity['requests'], minute_ago)
         
         # Count recent failed auth attempts
-        recent_failed_auth = len([
-            attempt for attempt in activity.get('failed_auth', [])
-            if datetime.fromisoformat(attempt) > minute_ago
-        ])
+        recent_failed_auth = _count_since(activity['failed_auth'], minute_ago)
         
         # Auto-ban conditions for API keys (only for auth failures, NOT for rate limiting)
         # We should NOT auto-block API keys for too many requests - that's what rate limiting is for
         should_ban = (
             # recent_requests > self.max_requests_per_minute or  # REMOVED: Don't block for rate limiting
             recent_failed_auth > 3 or  # Keep: Block for auth failures
-            len(activity.get('failed_auth', [])) > 20  # Keep: Block for total failed attempts
+            len(activity['failed_auth']) > 20  # Keep: Block for total failed attempts
         )
         
-        if should_ban and api_key not in self.blocked_api_keys:
+        if should_ban and key_hash not in self._blocked_api_keys_view:
             print(f"Auto-banning API key {api_key[:8]}... due to suspicious activity")
-            self.blocked_api_keys.add(api_key)
-            self.save_blocked_ips()
+            self.block_api_key(key_hash)
             
             # Also track this in security monitor
             from ..services.security_monitor import security_monitor
@@ -244,35 +364,106 @@ class IPBlockingMiddleware(BaseHTTPMiddleware):
                 }
             )
     
-    async def dispatch(self, request: Request, call_next):
-        client_ip = self.get_client_ip(request)
-        api_key = request.query_params.get("key", "")
+    async def _reject(self, scope: Scope, receive: Receive, send: Send, status_code: int, detail: str):
+        """Send an error response directly, without entering the application"""
+        response = JSONResponse({"detail": detail}, status_code=status_code)
+        await response(scope, receive, send)
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._blocked_ips_writer())
+        
+        content_length = _content_length(scope)
+        client_ip = client_ip_from_scope(scope)
+        api_key = QueryParams(scope["query_string"]).get("key", "")
         
         # Check if IP is blocked
         if self.is_ip_blocked(client_ip):
-            raise HTTPException(
-                status_code=403, 
-                detail="Your IP address has been blocked due to suspicious activity"
-            )
+            await self._reject(scope, receive, send, 403,
+                               "Your IP address has been blocked due to suspicious activity")
+            return
         
-        # Check if API key is blocked (PRIMARY PROTECTION)
-        if api_key and self.is_api_key_blocked(api_key):
-            raise HTTPException(
-                status_code=403,
-                detail="This API key has been blocked due to abuse"
-            )
+        # Check if API key is blocked (PRIMARY PROTECTION) - hash once, reused for tracking below
+        key_hash = _api_key_hash(api_key) if len(api_key) >= 8 else None
+        if key_hash is not None and key_hash in self._blocked_api_keys_view:
+            await self._reject(scope, receive, send, 403, "This API key has been blocked due to abuse")
+            return
         
-        # Track activity by IP
-        self.track_suspicious_activity(client_ip, 'request')
+        # Check concurrent requests limit
+        if self._concurrency.locked():
+            await self._reject(scope, receive, send, 429, "Server busy, too many concurrent requests")
+            return
+        
+        # Check request size (for POST/PUT requests)
+        if content_length:
+            try:
+                too_large = int(content_length) > self.max_request_size
+            except ValueError:
+                await self._reject(scope, receive, send, 400, "Invalid Content-Length header")
+                return
+            if too_large:
+                await self._reject(scope, receive, send, 413, "Request too large")
+                return
+        
+        # Track activity by IP (development IPs are never banned, so skip tracking them)
+        if client_ip not in _DEV_IPS:
+            self.track_suspicious_activity(client_ip, 'request')
         
         # Track activity by API key (if present)
-        if api_key:
-            self.track_api_key_activity(api_key, 'request')
+        if key_hash is not None:
+            self.track_api_key_activity(api_key, 'request', key_hash)
+        
+        # Add tracking info to response headers (for debugging, only when DEBUG_HEADERS is set)
+        tracking_headers = None
+        if _DEBUG_HEADERS:
+            tracking_headers = [(b"x-client-ip", client_ip.encode("latin-1"))]
+            if api_key:
+                tracking_headers.append((b"x-api-key-tracked", (api_key[:8] + "...").encode("latin-1")))
+        response_started = asyncio.Event()
         
-        # Add tracking info to response headers (for debugging)
-        response = await call_next(request)
-        response.headers["X-Client-IP"] = client_ip
-        if api_key:
-            response.headers["X-API-Key-Tracked"] = api_key[:8] + "..."
+        async def send_with_tracking(message: Message):
+            if message["type"] == "http.response.start":
+                response_started.set()
+                if tracking_headers:
+                    message["headers"] = list(message.get("headers", ())) + tracking_headers
+            await send(message)
         
-        return response
+        start_time = time.time()
+        
+        try:
+            async with self._concurrency:
+                # The timeout only covers the wait for the response to start: once headers are
+                # sent, a streamed body keeps flowing for as long as the app produces it
+                app_task = asyncio.create_task(self.app(scope, receive, send_with_tracking))
+                started = asyncio.create_task(response_started.wait())
+                try:
+                    await asyncio.wait(
+                        (app_task, started),
+                        timeout=self.request_timeout,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not app_task.done() and not response_started.is_set():
+                        app_task.cancel()
+                        await asyncio.wait((app_task,))
+                        await self._reject(scope, receive, send, 408, "Request timeout")
+                        return
+                    await app_task
+                finally:
+                    started.cancel()
+                    # Client disconnects cancel this call; don't leave the app running behind it
+                    if not app_task.done():
+                        app_task.cancel()
+        finally:
+            # Log slow requests
+            duration = time.time() - start_time
+            if duration > 10:  # Log requests taking more than 10 seconds
+                print(f"Slow request: {scope['path']} took {duration:.2f}s")
+
+async def flush_blocked_ips():
+    """Write out block-list saves still waiting on the debounce interval (call on shutdown)"""
+    for middleware in list(_instances):
+        await middleware.flush_blocked_ips()
@@ -6,27 +6,46 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
-import redis
+import redis.asyncio as aioredis
 from typing import Optional
+import asyncio
 import os
-from functools import lru_cache
 
 # Configuration
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 ENABLE_REDIS = os.getenv("ENABLE_REDIS_RATE_LIMIT", "false").lower() == "true"
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
 
-@lru_cache()
-def get_redis_client() -> Optional[redis.Redis]:
-    """Get Redis client if available, otherwise None for in-memory limiting"""
-    if not ENABLE_REDIS:
-        return None
-    try:
-        client = redis.from_url(REDIS_URL, decode_responses=True)
-        client.ping()  # Test connection
-        return client
-    except Exception:
-        print("Warning: Redis not available, using in-memory rate limiting")
-        return None
+# Shared async Redis client (single connection pool), created lazily on first use
+_redis_client: Optional[aioredis.Redis] = None
+_redis_checked = False
+_redis_lock = asyncio.Lock()
+
+async def get_redis_client() -> Optional[aioredis.Redis]:
+    """Get the shared async Redis client if available, otherwise None for in-memory limiting"""
+    global _redis_client, _redis_checked
+    if _redis_checked:
+        return _redis_client
+    
+    async with _redis_lock:
+        if _redis_checked:
+            return _redis_client
+        
+        if ENABLE_REDIS:
+            client = aioredis.Redis.from_url(
+                REDIS_URL,
+                decode_responses=True,
+                max_connections=REDIS_MAX_CONNECTIONS
+            )
+            try:
+                await client.ping()  # Test connection
+                _redis_client = client
+            except Exception:
+                print("Warning: Redis not available, using in-memory rate limiting")
+                await client.aclose()
+        
+        _redis_checked = True
+        return _redis_client
 
 def key_func(request: Request):
     """
@@ -6,68 +6,82 @@ from fastapi import Request, Response
 from fastapi.responses import JSONResponse
 import json
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
-from ..services.background_logger import log_security_event_background
+from starlette.types import ASGIApp, Receive, Scope, Send
+from ..services.background_logger import log_security_events_background
+from .client_ip import client_ip_from_scope
 import asyncio
 
-class SecurityLoggingMiddleware(BaseHTTPMiddleware):
-    """Middleware to log security events in the background after response"""
+# Bounded queue of security events waiting to be written; drained in batches by worker tasks
+_log_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+LOG_BATCH_SIZE = 256
+LOG_WORKER_COUNT = 2
+
+async def _security_log_worker():
+    """Long-lived consumer that flushes queued security events in batches"""
+    while True:
+        batch = [await _log_queue.get()]
+        while len(batch) < LOG_BATCH_SIZE and not _log_queue.empty():
+            batch.append(_log_queue.get_nowait())
+        
+        try:
+            await log_security_events_background(batch)
+        except Exception as e:
+            # Silent fail - don't break the application
+            print(f"Background security logging failed: {e}")
+
+class SecurityLoggingMiddleware:
+    """Pure ASGI middleware to log security events in the background after response"""
     
-    def __init__(self, app):
-        super().__init__(app)
-        self.security_events = {}  # Store events during request processing
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.dropped_events = 0  # Events discarded because the log queue was full
+        self._workers: list[asyncio.Task] = []
     
-    async def dispatch(self, request: Request, call_next):
-        # Store request start time
-        request.state.start_time = time.time()
-        request.state.security_events = []
+    def _enqueue(self, event: dict):
+        """Queue a security event for background logging, dropping it if the queue is full"""
+        try:
+            _log_queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped_events += 1
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        if not self._workers:
+            self._workers = [asyncio.create_task(_security_log_worker()) for _ in range(LOG_WORKER_COUNT)]
+        
+        # Store request start time and the event list on request.state (scope["state"])
+        state = scope.setdefault("state", {})
+        state["start_time"] = time.time()
+        state["security_events"] = []
+        
+        # Resolve the client IP once; inner middlewares and handlers reuse request.state.client_ip
+        client_ip = client_ip_from_scope(scope)
         
         # Process the request
         try:
-            response = await call_next(request)
-            
-            # Log any accumulated security events in background
-            if hasattr(request.state, 'security_events') and request.state.security_events:
-                for event in request.state.security_events:
-                    # Schedule background logging without waiting
-                    asyncio.create_task(self._log_security_event_async(event))
-            
-            return response
-            
+            await self.app(scope, receive, send)
         except Exception as e:
             # Log the error event
-            if hasattr(request.state, 'security_events'):
-                error_event = {
-                    "event_type": "API_ERROR",
-                    "client_ip": request.headers.get("x-forwarded-for", 
-                                                   request.client.host if request.client else "unknown"),
-                    "endpoint": request.url.path,
-                    "response_code": 500,
-                    "event_description": f"API error: {str(e)}",
-                    "severity": "ERROR"
-                }
-                asyncio.create_task(self._log_security_event_async(error_event))
-            
-            raise e
-    
-    async def _log_security_event_async(self, event_data):
-        """Background task to log security event"""
-        try:
-            await log_security_event_background(
-                event_type=event_data.get("event_type", "UNKNOWN"),
-                client_ip=event_data.get("client_ip", "unknown"),
-                api_key=event_data.get("api_key"),
-                client_id=event_data.get("client_id"),
-                endpoint=event_data.get("endpoint"),
-                response_code=event_data.get("response_code"),
-                event_description=event_data.get("event_description"),
-                event_data=event_data.get("event_data"),
-                user_agent=event_data.get("user_agent"),
-                severity=event_data.get("severity", "MEDIUM")
-            )
-        except Exception as e:
-            # Silent fail - don't break the application
-            print(f"Background security logging failed: {e}")
+            self._enqueue({
+                "event_type": "API_ERROR",
+                "client_ip": client_ip,
+                "endpoint": scope["path"],
+                "response_code": 500,
+                "event_description": f"API error: {str(e)}",
+                "severity": "ERROR"
+            })
+            raise
+        
+        # Queue any accumulated security events for background logging
+        for event in state.get("security_events", ()):
+            self._enqueue(event)
+
+def get_client_ip(request: Request) -> str:
+    """Get the client IP for a request, computed once and cached on request.state"""
+    return client_ip_from_scope(request.scope)
 
 # Helper function to add security events to the request context
 def add_security_event(request: Request, event_type: str, **kwargs):
@@ -75,8 +89,7 @@ def add_security_event(request: Request, event_type: str, **kwargs):
     if not hasattr(request.state, 'security_events'):
         request.state.security_events = []
     
-    client_ip = request.headers.get("x-forwarded-for", 
-                                  request.client.host if request.client else "unknown")
+    client_ip = get_client_ip(request)
     
     event = {
         "event_type": event_type,
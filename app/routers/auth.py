@@ -1,12 +1,17 @@
 # app/routers/auth.py
 from fastapi import APIRouter, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from typing import Optional
 import time
 from ..services.token_service import token_service
 from ..services.security_monitor import security_monitor
+from ..services.error_codes import ErrorCode, get_error_response
+from ..middleware.security_logging_middleware import get_client_ip
 
-router = APIRouter(tags=["authentication"])
+# Shortest credential worth passing to the token service (API keys are 36-char GUIDs, JWTs are longer)
+MIN_CREDENTIAL_LENGTH = 20
+
+router = APIRouter(tags=["authentication"], default_response_class=ORJSONResponse)
 
 @router.post("/auth/token")
 async def get_token(
@@ -30,8 +35,7 @@ async def get_token(
     }
     """
     start_time = time.time()
-    client_ip = request.headers.get("x-forwarded-for", 
-                                  request.client.host if request.client else "unknown")
+    client_ip = get_client_ip(request)  # Resolved once per request and cached on request.state
     
     if not authorization:
         security_monitor.log_suspicious_activity(
@@ -44,6 +48,14 @@ async def get_token(
             detail="Authorization header required"
         )
     
+    # Reject obviously malformed credentials before the token service ('Bearer ' prefix is optional)
+    credential = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    if len(credential) < MIN_CREDENTIAL_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=get_error_response(ErrorCode.AUTH_INVALID_FORMAT)
+        )
+    
     try:
         # Create token using the token service
         token_data = await token_service.create_token(authorization)
@@ -51,14 +63,14 @@ async def get_token(
         # Log successful token creation
         response_time = time.time() - start_time
         security_monitor.log_api_usage(
-            api_key=authorization.replace("Bearer ", "")[:8] + "...",
+            api_key=credential[:8] + "...",
             endpoint="/auth/token",
             ip=client_ip,
             response_code=200,
             response_time=response_time
         )
         
-        return JSONResponse(content=token_data)
+        return ORJSONResponse(content=token_data)
         
     except HTTPException as e:
         # Log failed token creation
@@ -1,154 +1,131 @@
 # app/routers/telemetry.py
-from fastapi import APIRouter, Depends, Query, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, Depends, Query, Request, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from typing import Dict, Any, Optional, List
 import csv, io
+import time
+import orjson
 
 from ..services.comprehensive_protection import comprehensive_api_protection
 from ..services.query_service import run_saved_query
 from ..services.error_codes import CodedError, ErrorCode
-from ..services.security_monitor import security_monitor
-from ..services.background_logger import log_api_request_background
+from ..services.background_logger import enqueue_api_request_log
+from ..middleware.security_logging_middleware import get_client_ip
 
-router = APIRouter(tags=["queries"])
+router = APIRouter(tags=["queries"], default_response_class=ORJSONResponse)
+
+STREAM_FLUSH_BYTES = 64 * 1024  # streamed CSV/JSON bodies are flushed in ~64KB chunks
+
+# Non-data params, excluded from the query inputs (minutes stays - it's a query parameter)
+_EXCLUDE_PARAMS = frozenset({"key", "q", "format", "demo", "stream"})
 
 @router.get("/run")
 async def run_saved(
-    background_tasks: BackgroundTasks,
     request: Request,
     q: str = Query(..., description="Query code (catalog key)"),
     cached_config = Depends(comprehensive_api_protection),  # Comprehensive API protection flow
     format: str = Query("json", pattern="^(json|csv)$"),
     demo: bool = Query(False, description="Return demo data instead of actual results"),
-    minutes: int = Query(None, description="Custom time window in minutes for the query")
+    minutes: int = Query(None, description="Custom time window in minutes for the query"),
+    stream: bool = Query(False, description="Stream JSON rows progressively instead of one response body")
 ):
-    import time
     start_time = time.time()
     
-    # Get client IP for logging
-    client_ip = request.headers.get("x-forwarded-for", request.client.host if request.client else "unknown")
-    
-    # API key is now extracted from headers via comprehensive protection
-    # Get the first 8 characters for logging (it's already been validated)
-    authorization = request.headers.get("authorization", "")
-    api_key_for_logging = ""
-    if authorization:
-        if authorization.startswith('Bearer '):
-            api_key_for_logging = authorization[7:15] + "..."  # First 8 chars + "..."
-        else:
-            api_key_for_logging = authorization[:8] + "..."
+    # Get client IP for logging (resolved once per request and cached on request.state)
+    client_ip = get_client_ip(request)
     
     # Collect all query params (leave them raw; service will filter/validate)
-    incoming: Dict[str, Any] = dict(request.query_params)
-    # Remove non-data params (keep minutes as it's a query parameter)
-    for drop in ("q", "format", "demo"):
-        incoming.pop(drop, None)
+    query_items = request.query_params.multi_items()
+    incoming: Dict[str, Any] = {k: v for k, v in query_items if k not in _EXCLUDE_PARAMS}
 
     # Server-provided values (you can add more later)
     server_context = {
         "client_id": cached_config.client_id
     }
 
+    # Request log fields, built once for the success and error paths
+    log_payload = {
+        "api_key": cached_config.api_key,
+        "client_id": cached_config.client_id,
+        "endpoint": f"/run?q={q}",
+        "client_ip": client_ip,
+        "query_params": query_items,  # raw (key, value) pairs; formatted by the background logger
+        "user_agent": request.headers.get("user-agent"),
+    }
+    status = 200
+    error_details = None
+    error_response = None
+
     try:
         rows, fieldnames = run_saved_query(query_id=q,
                                            incoming_params=incoming,
                                            server_context=server_context,
                                            demo_mode=demo)
-        
-        # Calculate response time for logging
-        response_time = time.time() - start_time
-        
-        # Log successful API usage with file logging (immediate)
-        security_monitor.log_api_usage(
-            api_key=cached_config.api_key,
-            endpoint=f"/run?q={q}",
-            ip=client_ip,
-            response_code=200,
-            response_time=response_time
-        )
-        
-        # Schedule database logging as background task (after response)
-        background_tasks.add_task(
-            log_api_request_background,
-            api_key=cached_config.api_key,
-            client_id=cached_config.client_id,
-            endpoint=f"/run?q={q}",
-            client_ip=client_ip,
-            response_code=200,
-            response_time=response_time,
-            query_params={"q": q, "format": format, "demo": demo, "minutes": minutes, **incoming},
-            user_agent=request.headers.get("user-agent")
-        )
-        
-    except CodedError as e:
-        # Log the error for monitoring with appropriate status code
-        response_time = time.time() - start_time
-        status = 404 if getattr(e, "error_code", None) == ErrorCode.QUERY_NOT_FOUND else 400
-        
-        # Immediate file logging
-        security_monitor.log_api_usage(
-            api_key=cached_config.api_key,
-            endpoint=f"/run?q={q}",
-            ip=client_ip,
-            response_code=status,
-            response_time=response_time
-        )
-        
-        # Schedule database logging as background task
-        background_tasks.add_task(
-            log_api_request_background,
-            api_key=cached_config.api_key,
-            client_id=cached_config.client_id,
-            endpoint=f"/run?q={q}",
-            client_ip=client_ip,
-            response_code=status,
-            response_time=response_time,
-            query_params={"q": q, "format": format, "demo": demo, "minutes": minutes, **incoming},
-            user_agent=request.headers.get("user-agent"),
-            error_details=str(e.to_dict())
-        )
-        
-        raise HTTPException(status_code=status, detail=e.to_dict())
-    except ValueError as e:
-        # Fallback for any remaining simple string errors
-        response_time = time.time() - start_time
-        
-        # Immediate file logging
-        security_monitor.log_api_usage(
-            api_key=cached_config.api_key,
-            endpoint=f"/run?q={q}",
-            ip=client_ip,
-            response_code=400,
-            response_time=response_time
-        )
-        
-        # Schedule database logging as background task
-        background_tasks.add_task(
-            log_api_request_background,
-            api_key=cached_config.api_key,
-            client_id=cached_config.client_id,
-            endpoint=f"/run?q={q}",
-            client_ip=client_ip,
-            response_code=400,
-            response_time=response_time,
-            query_params={"q": q, "format": format, "demo": demo, "minutes": minutes, **incoming},
-            user_agent=request.headers.get("user-agent"),
-            error_details=str(e)
-        )
-        
-        raise HTTPException(status_code=400, detail=str(e))
+    except (CodedError, ValueError) as e:
+        if isinstance(e, CodedError):
+            status = 404 if getattr(e, "error_code", None) == ErrorCode.QUERY_NOT_FOUND else 400
+            error_response = e.to_dict()
+            error_details = str(error_response)
+        else:
+            # Fallback for any remaining simple string errors
+            status = 400
+            error_response = error_details = str(e)
+
+    # File and database logging are batched by the background log consumer
+    enqueue_api_request_log(
+        response_code=status,
+        response_time=time.time() - start_time,
+        error_details=error_details,
+        **log_payload
+    )
+
+    if error_response is not None:
+        raise HTTPException(status_code=status, detail=error_response)
 
     if format == "json":
-        return JSONResponse(rows)
+        # Line-delimited JSON when the client asks for it
+        if "application/x-ndjson" in request.headers.get("accept", ""):
+            def iter_ndjson():
+                buf = bytearray()
+                for r in rows:
+                    buf += orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE)
+                    if len(buf) > STREAM_FLUSH_BYTES:
+                        yield bytes(buf); buf.clear()
+                if buf:
+                    yield bytes(buf)
+
+            return StreamingResponse(iter_ndjson(), media_type="application/x-ndjson")
+
+        if stream:
+            # Same JSON array as below, emitted in chunks as rows are serialized
+            def iter_json():
+                buf = bytearray(b"[")
+                for i, r in enumerate(rows):
+                    if i:
+                        buf += b","
+                    buf += orjson.dumps(r)
+                    if len(buf) > STREAM_FLUSH_BYTES:
+                        yield bytes(buf); buf.clear()
+                buf += b"]"
+                yield bytes(buf)
+
+            return StreamingResponse(iter_json(), media_type="application/json")
+
+        return ORJSONResponse(rows)
 
     # CSV stream with dynamic columns
     def iter_csv():
         buf = io.StringIO()
-        fn = fieldnames or (rows[0].keys() if rows else [])
-        writer = csv.DictWriter(buf, fieldnames=fn, extrasaction="ignore")
-        writer.writeheader(); yield buf.getvalue(); buf.seek(0); buf.truncate(0)
+        cols = tuple(fieldnames or (rows[0].keys() if rows else ()))
+        writer = csv.writer(buf)
+        writer.writerow(cols)
+        # Flush in ~64KB chunks rather than once per row
         for r in rows:
-            writer.writerow(r); yield buf.getvalue(); buf.seek(0); buf.truncate(0)
+            writer.writerow([r.get(c, "") for c in cols])
+            if buf.tell() > STREAM_FLUSH_BYTES:
+                yield buf.getvalue(); buf.seek(0); buf.truncate(0)
+        if buf.tell():
+            yield buf.getvalue()
 
     return StreamingResponse(iter_csv(), media_type="text/csv",
                              headers={"Content-Disposition": f'attachment; filename=\"{q}.csv\"'})
@@ -1,9 +1,58 @@
 # app/services/auth.py
 from fastapi import HTTPException, Header
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from sqlalchemy import text
+import asyncio
+import time
 from .db import get_engine
 from .error_codes import ErrorCode, get_error_response
+from .call_validator import API_KEY_RE
+
+# In-process cache of resolved API keys:
+# {api_key: (client_id, expires_at, next last-used touch at) - both as time.monotonic()}
+# Only keys that were found in the database are stored, so the size is bounded by valid keys
+_client_id_cache: Dict[str, Tuple[int, float, float]] = {}
+_CLIENT_ID_TTL = 300.0  # seconds
+_LAST_USED_INTERVAL = 60.0  # seconds - cache hits refresh last_api_key_used at most this often
+
+# Strong references to the last-used touch tasks (the event loop only keeps weak ones)
+_background_tasks: set = set()
+
+def _touch_api_key(api_key: str):
+    """(Optional) audit: last_used_at - best effort, runs off the request path"""
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(text("""
+                UPDATE app.api_keys
+                SET last_api_key_used = SYSUTCDATETIME()
+                WHERE token = :k
+            """), {"k": api_key})
+    except Exception:
+        pass
+
+def _touch_in_background(api_key: str):
+    """Record last use off the request path, holding the task until it finishes"""
+    task = asyncio.create_task(asyncio.to_thread(_touch_api_key, api_key))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def clear_client_id_cache(api_key: Optional[str] = None):
+    """Forget one cached API key (e.g. just revoked) or, with no argument, all of them"""
+    if api_key is None:
+        _client_id_cache.clear()
+    else:
+        _client_id_cache.pop(api_key, None)
+
+def _select_account(api_key: str):
+    """Account row (prev_id) for an API key, or None (blocking - called through asyncio.to_thread)"""
+    sql = text("""
+        SELECT prev_id as account_id
+        FROM enervibe.accounts
+        WHERE api_key = :k 
+    """)
+    # Single read - autocommit, so no BEGIN/COMMIT framing around the SELECT
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        return conn.execute(sql, {"k": api_key}).first()
 
 def extract_api_key_from_header(authorization: Optional[str] = Header(None)) -> str:
     """
@@ -15,12 +64,8 @@ def extract_api_key_from_header(authorization: Optional[str] = Header(None)) ->
         error_response = get_error_response(ErrorCode.AUTH_ACCESS_DENIED)
         raise HTTPException(status_code=401, detail=error_response)
     
-    # Handle 'Bearer TOKEN' format
-    if authorization.startswith('Bearer '):
-        return authorization[7:]  # Remove 'Bearer ' prefix
-    
-    # Handle direct token format
-    return authorization
+    # Handle 'Bearer TOKEN' format, otherwise direct token format
+    return authorization[7:] if authorization.startswith('Bearer ') else authorization
 
 async def resolve_client_from_jwt_token(token: str) -> int:
     """
@@ -48,39 +93,35 @@ async def resolve_account_from_header(authorization: Optional[str] = Header(None
         return await resolve_client_from_jwt_token(token_or_key)
     
     # Otherwise, treat it as an API key
-    # Basic validation for GUID format
-    import re
-    guid_pattern = r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'
-    if not re.match(guid_pattern, token_or_key):
+    # Basic validation for GUID format (length first - rejects scanner garbage without the regex)
+    if len(token_or_key) != 36 or not API_KEY_RE.match(token_or_key):
         error_response = get_error_response(ErrorCode.AUTH_INVALID_FORMAT)
         raise HTTPException(status_code=400, detail=error_response)
     
+    # Recently resolved key - no database round-trip
+    now = time.monotonic()
+    cached = _client_id_cache.get(token_or_key)
+    if cached and cached[1] > now:
+        client_id, expires_at, touch_at = cached
+        if touch_at <= now:
+            # Keep last_api_key_used current for keys served from the cache
+            _client_id_cache[token_or_key] = (client_id, expires_at, now + _LAST_USED_INTERVAL)
+            _touch_in_background(token_or_key)
+        return client_id
+    
     try:
-        engine = get_engine()
-        sql = text("""
-            SELECT prev_id as account_id
-            FROM enervibe.accounts
-            WHERE api_key = :k 
-        """)
-        with engine.begin() as conn:
-            row = conn.execute(sql, {"k": token_or_key}).first()
+        # Blocking pyodbc round-trip - run in a worker thread so the event loop keeps serving
+        row = await asyncio.to_thread(_select_account, token_or_key)
 
         if not row:
             error_response = get_error_response(ErrorCode.AUTH_ACCESS_DENIED)
             raise HTTPException(status_code=401, detail=error_response)
 
         client_id = int(row[0])  # prev_id is the client_id
+        _client_id_cache[token_or_key] = (client_id, now + _CLIENT_ID_TTL, now + _LAST_USED_INTERVAL)
 
-        # (Optional) audit: last_used_at
-        try:
-            with engine.begin() as conn:
-                conn.execute(text("""
-                    UPDATE app.api_keys
-                    SET last_api_key_used = SYSUTCDATETIME()
-                    WHERE token = :k
-                """), {"k": token_or_key})
-        except Exception:
-            pass
+        # Record last use in the background instead of holding up the request
+        _touch_in_background(token_or_key)
 
         return client_id
         
@@ -2,13 +2,86 @@
 Background Database Logger
 Utility functions for asynchronous database logging that runs after responses are sent
 """
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple, Union
+from sqlalchemy import text
+import asyncio
+import orjson
+from .db import get_engine
 from .security_event_logger import SecurityEventLogger
-from .security_monitor import security_monitor
+from .security_monitor import security_monitor, mask_key
 
 # Global database logger instance
 db_logger = SecurityEventLogger()
 
+# api_request_log statements, built once at import
+_API_REQUEST_LOG_EXISTS = text("""
+    SELECT COUNT(*) as table_exists 
+    FROM INFORMATION_SCHEMA.TABLES 
+    WHERE TABLE_SCHEMA = 'app' AND TABLE_NAME = 'api_request_log'
+""")
+
+# Cached result of _API_REQUEST_LOG_EXISTS (None until first checked)
+_api_request_log_exists: Optional[bool] = None
+
+_INSERT_API_REQUEST_LOG = text("""
+    INSERT INTO app.api_request_log (
+        request_timestamp, api_key, client_id, endpoint, 
+        source_ip, response_code, response_time_seconds, 
+        query_params, user_agent, error_details
+    )
+    VALUES (
+        GETDATE(), :api_key, :client_id, :endpoint,
+        :source_ip, :response_code, :response_time,
+        :query_params, :user_agent, :error_details
+    )
+""")
+
+# Bounded queue of API request log entries; drained in batches by a single consumer task
+_api_request_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+API_LOG_BATCH_SIZE = 500
+API_LOG_FLUSH_INTERVAL = 0.1  # seconds a batch waits for more entries before it is written
+_api_request_consumer: Optional[asyncio.Task] = None
+# Cap on concurrent background log writes (each holds a pooled connection while it runs)
+_db_log_semaphore = asyncio.Semaphore(8)
+dropped_api_request_logs = 0  # Entries discarded because the queue was full
+
+async def _api_request_log_consumer():
+    """Long-lived consumer that writes queued API request logs in batches (up to ~100ms or 500 entries)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _api_request_queue.get()]
+        deadline = loop.time() + API_LOG_FLUSH_INTERVAL
+        while len(batch) < API_LOG_BATCH_SIZE:
+            if not _api_request_queue.empty():
+                batch.append(_api_request_queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_api_request_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await log_api_requests_background(batch)
+        except Exception as e:
+            # Silent fail - don't break the application
+            print(f"Background API request logging failed: {e}")
+
+def enqueue_api_request_log(**entry):
+    """
+    Queue an API request for logging (same keywords as log_api_request_background).
+    Non-blocking; the consumer task is started on first use, and entries are dropped if the queue is full.
+    """
+    global _api_request_consumer, dropped_api_request_logs
+    if _api_request_consumer is None or _api_request_consumer.done():
+        _api_request_consumer = asyncio.create_task(_api_request_log_consumer())
+    try:
+        _api_request_queue.put_nowait(entry)
+    except asyncio.QueueFull:
+        dropped_api_request_logs += 1
+
 async def log_api_request_background(
     api_key: str,
     client_id: int,
@@ -16,55 +89,81 @@ async def log_api_request_background(
     client_ip: str,
     response_code: int,
     response_time: float,
-    query_params: Dict[str, Any],
+    query_params: Union[Dict[str, Any], List[Tuple[str, str]]],
     user_agent: Optional[str] = None,
     error_details: Optional[str] = None
 ):
-    """Background task to log API request to database"""
-    try:
-        event_data = {
-            "query_params": query_params,
-            "response_time_seconds": response_time
-        }
-        
-        if error_details:
-            event_data["error_details"] = error_details
-        
-        # Log to both security_events AND api_request_log tables
-        await db_logger.log_security_event(
-            event_type="API_REQUEST",
-            event_description=f"API request to {endpoint}",
-            source_ip=client_ip,
-            api_key=api_key[:8] + "..." if len(api_key) > 8 else api_key,  # Only log partial key
-            client_id=client_id,
-            event_severity="INFO" if response_code < 400 else "WARN",
-            endpoint=endpoint,
-            response_code=response_code,
-            event_data=event_data,
-            user_agent=user_agent
-        )
+    """Background task to log API request to the usage log file and database"""
+    await log_api_requests_background([{
+        "api_key": api_key,
+        "client_id": client_id,
+        "endpoint": endpoint,
+        "client_ip": client_ip,
+        "response_code": response_code,
+        "response_time": response_time,
+        "query_params": query_params,
+        "user_agent": user_agent,
+        "error_details": error_details
+    }])
+
+async def log_api_requests_background(entries: List[Dict[str, Any]]):
+    """Log a batch of API requests (keywords of log_api_request_background) to the usage log file and database"""
+    for entry in entries:
+        if not isinstance(entry["query_params"], dict):
+            # Raw (key, value) pairs from request.query_params.multi_items()
+            entry["query_params"] = dict(entry["query_params"])
         
-        # Also log to the specific api_request_log table if it exists
-        await log_to_api_request_log_table(
-            api_key=api_key,
-            client_id=client_id,
-            endpoint=endpoint,
-            client_ip=client_ip,
-            response_code=response_code,
-            response_time=response_time,
-            query_params=query_params,
-            user_agent=user_agent,
-            error_details=error_details
-        )
+        # File logging first - kept here so file I/O stays off the request path
+        try:
+            security_monitor.log_api_usage(
+                api_key=entry["api_key"],
+                endpoint=entry["endpoint"],
+                ip=entry["client_ip"],
+                response_code=entry["response_code"],
+                response_time=entry["response_time"]
+            )
+        except Exception:
+            pass
+    
+    try:
+        # Log to both security_events AND api_request_log tables - one round-trip each for the whole batch,
+        # run concurrently, with the number of in-flight log writes capped so bursts can't drain the pool
+        async with _db_log_semaphore:
+            await asyncio.gather(
+                db_logger.log_security_events(_api_request_events(entries)),
+                log_to_api_request_log_table_batch(entries)
+            )
         
     except Exception as e:
         # Log to file as fallback if database logging fails
         security_monitor.log_suspicious_activity(
-            f"Database logging failed for API request: {str(e)}", 
-            client_ip, 
-            api_key[:8] + "..." if len(api_key) > 8 else api_key
+            f"Database logging failed for {len(entries)} API requests: {str(e)}", 
+            "system", 
+            None
         )
 
+def _api_request_events(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """security_events rows (log_security_events keywords) for a batch of API request log entries"""
+    return [
+        {
+            "event_type": "API_REQUEST",
+            "event_description": f"API request to {entry['endpoint']}",
+            "source_ip": entry["client_ip"],
+            "api_key": mask_key(entry["api_key"]),  # Only log partial key
+            "client_id": entry["client_id"],
+            "event_severity": "INFO" if entry["response_code"] < 400 else "WARN",
+            "endpoint": entry["endpoint"],
+            "response_code": entry["response_code"],
+            "event_data": {
+                "query_params": entry["query_params"],
+                "response_time_seconds": entry["response_time"],
+                **({"error_details": entry["error_details"]} if entry.get("error_details") else {})
+            },
+            "user_agent": entry.get("user_agent")
+        }
+        for entry in entries
+    ]
+
 async def log_to_api_request_log_table(
     api_key: str,
     client_id: int,
@@ -77,60 +176,85 @@ async def log_to_api_request_log_table(
     error_details: Optional[str] = None
 ):
     """Log specifically to app.api_request_log table"""
+    await log_to_api_request_log_table_batch([{
+        "api_key": api_key,
+        "client_id": client_id,
+        "endpoint": endpoint,
+        "client_ip": client_ip,
+        "response_code": response_code,
+        "response_time": response_time,
+        "query_params": query_params,
+        "user_agent": user_agent,
+        "error_details": error_details
+    }])
+
+def api_request_log_table_exists() -> bool:
+    """
+    Whether app.api_request_log exists - queried once, then cached for the process lifetime
+    (blocking on first call; the schema is fixed while the app runs)
+    """
+    global _api_request_log_exists
+    if _api_request_log_exists is None:
+        with get_engine().connect() as conn:
+            _api_request_log_exists = bool(conn.execute(_API_REQUEST_LOG_EXISTS).scalar())
+    return _api_request_log_exists
+
+def _write_api_request_log_rows(rows: List[Dict[str, Any]]) -> bool:
+    """
+    Insert api_request_log rows in one transaction with a single executemany (blocking - run through
+    asyncio.to_thread). Returns False if the table does not exist.
+    """
+    if not api_request_log_table_exists():
+        return False
+    with get_engine().begin() as conn:
+        conn.execute(_INSERT_API_REQUEST_LOG, rows)
+    return True
+
+async def log_to_api_request_log_table_batch(entries: List[Dict[str, Any]]):
+    """Log a batch of API requests (keywords of log_to_api_request_log_table) to app.api_request_log"""
+    if not entries:
+        return
+    
+    rows = [
+        {
+            "api_key": mask_key(entry["api_key"]),
+            "client_id": entry["client_id"],
+            "endpoint": entry["endpoint"],
+            "source_ip": entry["client_ip"],
+            "response_code": entry["response_code"],
+            "response_time": entry["response_time"],
+            "query_params": orjson.dumps(entry["query_params"]).decode() if entry["query_params"] else None,
+            "user_agent": entry.get("user_agent"),
+            "error_details": entry.get("error_details")
+        }
+        for entry in entries
+    ]
+    
     try:
-        from .db import get_engine
-        from sqlalchemy import text
-        import json
-        
-        engine = get_engine()
-        
-        with engine.begin() as conn:
-            # Check if the table exists first
-            table_check = conn.execute(text("""
-                SELECT COUNT(*) as table_exists 
-                FROM INFORMATION_SCHEMA.TABLES 
-                WHERE TABLE_SCHEMA = 'app' AND TABLE_NAME = 'api_request_log'
-            """)).scalar()
-            
-            if table_check > 0:
-                conn.execute(text("""
-                    INSERT INTO app.api_request_log (
-                        request_timestamp, api_key, client_id, endpoint, 
-                        source_ip, response_code, response_time_seconds, 
-                        query_params, user_agent, error_details
-                    )
-                    VALUES (
-                        GETDATE(), :api_key, :client_id, :endpoint,
-                        :source_ip, :response_code, :response_time,
-                        :query_params, :user_agent, :error_details
-                    )
-                """), {
-                    "api_key": api_key[:8] + "..." if len(api_key) > 8 else api_key,
-                    "client_id": client_id,
-                    "endpoint": endpoint,
-                    "source_ip": client_ip,
-                    "response_code": response_code,
-                    "response_time": response_time,
-                    "query_params": json.dumps(query_params) if query_params else None,
-                    "user_agent": user_agent,
-                    "error_details": error_details
-                })
-            else:
-                # Table doesn't exist, log this info
-                security_monitor.log_suspicious_activity(
-                    "Table app.api_request_log does not exist for logging", 
-                    client_ip, 
-                    api_key[:8] + "..." if len(api_key) > 8 else api_key
-                )
+        if not await asyncio.to_thread(_write_api_request_log_rows, rows):
+            # Table doesn't exist, log this info
+            security_monitor.log_suspicious_activity(
+                "Table app.api_request_log does not exist for logging", 
+                rows[0]["source_ip"], 
+                rows[0]["api_key"]
+            )
                 
     except Exception as e:
         # Log the specific error
         security_monitor.log_suspicious_activity(
-            f"Failed to log to app.api_request_log table: {str(e)}", 
-            client_ip, 
-            api_key[:8] + "..." if len(api_key) > 8 else api_key
+            f"Failed to log {len(rows)} rows to app.api_request_log table: {str(e)}", 
+            rows[0]["source_ip"], 
+            rows[0]["api_key"]
         )
 
+async def flush_api_request_logs():
+    """Write out every queued API request log entry now (called on shutdown so nothing queued is lost)"""
+    batch = []
+    while not _api_request_queue.empty():
+        batch.append(_api_request_queue.get_nowait())
+    if batch:
+        await log_api_requests_background(batch)
+
 async def log_security_event_background(
     event_type: str,
     client_ip: str,
@@ -149,7 +273,7 @@ async def log_security_event_background(
             event_type=event_type,
             event_description=event_description or f"Security event: {event_type}",
             source_ip=client_ip,
-            api_key=api_key[:8] + "..." if api_key and len(api_key) > 8 else api_key,
+            api_key=mask_key(api_key) if api_key else api_key,
             client_id=client_id,
             event_severity=severity,
             endpoint=endpoint,
@@ -162,7 +286,34 @@ async def log_security_event_background(
         security_monitor.log_suspicious_activity(
             f"Database logging failed for security event {event_type}: {str(e)}", 
             client_ip, 
-            api_key[:8] + "..." if api_key and len(api_key) > 8 else api_key
+            mask_key(api_key) if api_key else api_key
+        )
+
+async def log_security_events_background(events: List[Dict[str, Any]]):
+    """Background task to log a batch of security events to database in one round-trip"""
+    try:
+        async with _db_log_semaphore:
+            await db_logger.log_security_events([
+                {
+                    "event_type": event.get("event_type", "UNKNOWN"),
+                    "event_description": event.get("event_description") or f"Security event: {event.get('event_type', 'UNKNOWN')}",
+                    "source_ip": event.get("client_ip", "unknown"),
+                    "api_key": mask_key(event["api_key"]) if event.get("api_key") else event.get("api_key"),
+                    "client_id": event.get("client_id"),
+                    "event_severity": event.get("severity", "MEDIUM"),
+                    "endpoint": event.get("endpoint"),
+                    "response_code": event.get("response_code"),
+                    "event_data": event.get("event_data"),
+                    "user_agent": event.get("user_agent")
+                }
+                for event in events
+            ])
+    except Exception as e:
+        # Log to file as fallback if database logging fails
+        security_monitor.log_suspicious_activity(
+            f"Database logging failed for {len(events)} security events: {str(e)}", 
+            "system", 
+            None
         )
 
 async def log_rate_limit_violation_background(
@@ -179,7 +330,7 @@ async def log_rate_limit_violation_background(
     try:
         await db_logger.log_rate_limit_violation(
             source_ip=client_ip,
-            api_key=api_key[:8] + "..." if len(api_key) > 8 else api_key,
+            api_key=mask_key(api_key),
             client_id=client_id,
             endpoint=endpoint,
             violation_type=violation_type,
@@ -192,5 +343,5 @@ async def log_rate_limit_violation_background(
         security_monitor.log_suspicious_activity(
             f"Database logging failed for rate limit violation: {str(e)}", 
             client_ip, 
-            api_key[:8] + "..." if len(api_key) > 8 else api_key
+            mask_key(api_key)
         )
@@ -6,6 +6,9 @@ from fastapi import Request, HTTPException
 from typing import Dict, Any, Optional
 import re
 
+# API key format (GUID, either case), compiled once at import - shared with services.auth
+API_KEY_RE = re.compile(r'[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}\Z', re.IGNORECASE)
+
 class CallStructureValidator:
     """Validates API call structure"""
     
@@ -14,9 +17,6 @@ class CallStructureValidator:
         self.required_params = ["q"]
         self.optional_params = ["demo", "format", "limit", "order_by", "order_desc", "minutes"]
         
-        # API key format validation (basic)
-        self.api_key_pattern = re.compile(r'^[A-F0-9]{8}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{12}$')
-        
         # Query code validation (basic)
         self.query_code_pattern = re.compile(r'^[a-zA-Z0-9_-]{1,50}$')
     
@@ -43,8 +43,9 @@ class CallStructureValidator:
             if not api_key:
                 return False, "API key required in Authorization header", {}
             
-            # Validate API key format (GUID) or JWT token
-            if api_key.startswith('eyJ'):
+            # Validate API key format (GUID) or JWT token - classified once, downstream branches on key_type
+            is_jwt = api_key.startswith('eyJ')
+            if is_jwt:
                 # JWT token - basic validation (starts with 'eyJ')
                 if len(api_key) < 50:  # JWT tokens are much longer
                     return False, "Invalid JWT token format", {}
@@ -55,6 +56,7 @@ class CallStructureValidator:
             
             # Add API key to params for downstream processing
             params["key"] = api_key
+            params["key_type"] = "jwt" if is_jwt else "api_key"
             
             # Check required parameters exist
             for required_param in self.required_params:
@@ -110,11 +112,8 @@ class CallStructureValidator:
     
     def _is_valid_api_key(self, api_key: str) -> bool:
         """Validate API key format (GUID format)"""
-        if not api_key or len(api_key) < 8:
-            return False
-        
-        # Check if it matches GUID pattern
-        return bool(self.api_key_pattern.match(api_key.upper()))
+        # Precompiled and case-insensitive, so no upper() copy of the key
+        return API_KEY_RE.match(api_key) is not None
     
     def _is_valid_query_code(self, query_code: str) -> bool:
         """Validate query code format"""
@@ -8,29 +8,65 @@ Follows the exact flow specified:
 """
 from fastapi import Request, HTTPException, Depends
 from typing import Optional
+import asyncio
 import time
+from collections import deque
+from itertools import islice
 from .ip_brutal_tracker import ip_brutal_tracker
 from .call_validator import call_validator
 from .rate_limit_cache import rate_limit_cache, CachedRateLimit
-from .security_monitor import security_monitor
-from datetime import datetime, timedelta
+from .security_monitor import security_monitor, mask_key
+from .db_access_control import record_usage, ClientAPIAccess, CLIENT_API_ACCESS_COLUMNS
+from .db import get_engine
+from .error_codes import ErrorCode, get_error_response
+from .token_service import token_service
+from sqlalchemy import text
+from ..middleware.security_logging_middleware import get_client_ip, add_security_event
 
 # Helper function to add security events for background logging
 def add_security_event_to_request(request: Request, event_type: str, **kwargs):
     """Add a security event to be logged in background after response"""
-    try:
-        from ..middleware.security_logging_middleware import add_security_event
-        add_security_event(request, event_type, **kwargs)
-    except ImportError:
-        # Fallback to immediate file logging if middleware not available
-        security_monitor.log_suspicious_activity(
-            event_type, 
-            request.headers.get("x-forwarded-for", request.client.host if request.client else "unknown"),
-            kwargs
-        )
+    add_security_event(request, event_type, **kwargs)
+
+def report_security_event(request: Request, client_ip: str, event_type: str, details: dict, **kwargs):
+    """
+    Send one security event to both sinks from a single details dict: the security log file now
+    (queued, off the event loop) and the database after the response, with details as event_data.
+    """
+    security_monitor.log_suspicious_activity(event_type, client_ip, details)
+    add_security_event(request, event_type, event_data=details, **kwargs)
+
+# Account lookups (blocking pyodbc round-trips - called through asyncio.to_thread).
+# Each also returns the key's client_api_access row, so a cold rate limit cache is primed from the
+# same round-trip instead of a second query in step 4.
+# Single reads, so autocommit: no BEGIN/COMMIT framing around the SELECT.
+_ACCOUNT_WITH_ACCESS = f"""
+    SELECT a.prev_id as account_id, a.api_key as account_api_key,
+           {", ".join("c." + column for column in CLIENT_API_ACCESS_COLUMNS)}
+    FROM enervibe.accounts a
+    LEFT JOIN app.client_api_access c ON c.api_key = a.api_key
+"""
+
+_SELECT_ACCOUNT_BY_CLIENT = text(_ACCOUNT_WITH_ACCESS + "WHERE a.prev_id = :client_id")
+
+_SELECT_ACCOUNT = text(_ACCOUNT_WITH_ACCESS + "WHERE a.api_key = :k")
+
+def _select_account_by_client(client_id: int):
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        return conn.execute(_SELECT_ACCOUNT_BY_CLIENT, {"client_id": client_id}).mappings().first()
+
+def _select_account(api_key: str):
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        return conn.execute(_SELECT_ACCOUNT, {"k": api_key}).mappings().first()
+
+def _prime_rate_limit_cache(row):
+    """Cache the client_api_access part of a fused account row (no access row - nothing to cache)"""
+    if row["access_id"] is not None:
+        rate_limit_cache.prime(ClientAPIAccess(dict(row)))
 
 # In-memory usage tracking for rate limiting windows
-# Format: {api_key: {minute: [], hour: [], day: []}}
+# Format: {api_key: {minute: deque of time.monotonic() timestamps (sliding 60s window, at most
+#                            requests_per_minute entries), hour: [bucket, count], day: [bucket, count]}}
 usage_windows = {}
 
 async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
@@ -45,8 +81,8 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
     start_time = time.time()
     
     # Step 1: Track IP for brutal attack detection (ALWAYS - regardless of call structure)
-    client_ip = request.headers.get("x-forwarded-for", 
-                                  request.client.host if request.client else "unknown")
+    # (resolved once per request and cached on request.state by the security logging middleware)
+    client_ip = get_client_ip(request)
     
     # Track this IP request for brutal attack detection
     is_ip_blocked = ip_brutal_tracker.track_ip_request(client_ip)
@@ -54,21 +90,15 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
     if is_ip_blocked:
         blocked_reason = ip_brutal_tracker.is_ip_blocked(client_ip)[1]
         
-        # Immediate file logging
-        security_monitor.log_suspicious_activity(
-            "IP_BLOCKED_BRUTAL_ATTACK",
-            client_ip,
-            {"reason": blocked_reason, "endpoint": request.url.path}
-        )
-        
-        # Schedule background database logging
-        add_security_event_to_request(
+        # Immediate file logging + background database logging
+        report_security_event(
             request,
+            client_ip,
             "IP_BLOCKED_BRUTAL_ATTACK",
+            {"reason": blocked_reason, "endpoint": request.url.path},
             event_description=f"IP blocked due to brutal attack: {blocked_reason}",
             response_code=429,
-            severity="HIGH",
-            event_data={"reason": blocked_reason, "endpoint": request.url.path}
+            severity="HIGH"
         )
         
         raise HTTPException(
@@ -81,30 +111,20 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
     
     if not is_valid_structure:
         # Wrong call structure - this counts toward IP brutal attack measure
-        
-        # Immediate file logging
-        security_monitor.log_suspicious_activity(
-            "INVALID_CALL_STRUCTURE",
+        # Immediate file logging + background database logging (validated_params is empty here,
+        # so log the raw params - converted once, shared by both sinks)
+        report_security_event(
+            request,
             client_ip,
+            "INVALID_CALL_STRUCTURE",
             {
                 "error": structure_error,
                 "endpoint": request.url.path,
                 "query_params": dict(request.query_params)
-            }
-        )
-        
-        # Schedule background database logging
-        add_security_event_to_request(
-            request,
-            "INVALID_CALL_STRUCTURE",
+            },
             event_description=f"Invalid call structure: {structure_error}",
             response_code=400,
-            severity="MEDIUM",
-            event_data={
-                "error": structure_error,
-                "endpoint": request.url.path,
-                "query_params": dict(request.query_params)
-            }
+            severity="MEDIUM"
         )
         
         raise HTTPException(status_code=400, detail=f"Invalid call structure: {structure_error}")
@@ -113,67 +133,42 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
     api_key_or_token = validated_params["key"]
     
     try:
-        # Check if it's a JWT token (starts with 'eyJ')
-        if api_key_or_token.startswith('eyJ'):
+        # JWT or API key - already classified by call_validator in step 2
+        if validated_params["key_type"] == "jwt":
             # JWT token authentication
-            from .token_service import token_service
             payload = token_service.verify_token(api_key_or_token)
             client_id = payload.get("client_id")
             
             # For rate limiting, we need the original API key
             # Let's get it from the database using the client_id
-            from .db import get_engine
-            from sqlalchemy import text
-            engine = get_engine()
-            sql = text("""
-                SELECT api_key
-                FROM enervibe.accounts
-                WHERE prev_id = :client_id 
-            """)
-            with engine.begin() as conn:
-                row = conn.execute(sql, {"client_id": client_id}).first()
+            row = await asyncio.to_thread(_select_account_by_client, client_id)
             
             if not row:
-                from .error_codes import ErrorCode, get_error_response
                 error_response = get_error_response(ErrorCode.AUTH_ACCESS_DENIED)
                 raise HTTPException(status_code=401, detail=error_response)
                 
-            api_key = row[0]  # Use the original API key for rate limiting
+            api_key = row["account_api_key"]  # Use the original API key for rate limiting
+            _prime_rate_limit_cache(row)
         else:
-            # API key authentication
+            # API key authentication - GUID format already checked by call_validator in step 2
             api_key = api_key_or_token
             
-            # Import here to avoid circular imports
-            from .db import get_engine
-            from .error_codes import ErrorCode, get_error_response
-            from sqlalchemy import text
-            import re
-            
-            # Basic validation for GUID format
-            guid_pattern = r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'
-            if not re.match(guid_pattern, api_key):
-                error_response = get_error_response(ErrorCode.AUTH_INVALID_FORMAT)
-                raise HTTPException(status_code=400, detail=error_response)
-            
-            # Direct database lookup
-            engine = get_engine()
-            sql = text("""
-                SELECT prev_id as account_id
-                FROM enervibe.accounts
-                WHERE api_key = :k 
-            """)
-            with engine.begin() as conn:
-                row = conn.execute(sql, {"k": api_key}).first()
+            # Direct database lookup (worker thread - pyodbc blocks)
+            row = await asyncio.to_thread(_select_account, api_key)
 
             if not row:
                 error_response = get_error_response(ErrorCode.AUTH_ACCESS_DENIED)
                 raise HTTPException(status_code=401, detail=error_response)
 
-            client_id = int(row[0])  # prev_id is the client_id
+            client_id = int(row["account_id"])  # prev_id is the client_id
+            _prime_rate_limit_cache(row)
+        
+        # Mask once per request for the log calls below
+        masked_key = mask_key(api_key)
         
         # Log successful authentication
         security_monitor.log_api_usage(
-            api_key=api_key[:8] + "..." if len(api_key) > 8 else api_key,
+            api_key=masked_key,
             endpoint=request.url.path,
             ip=client_ip,
             response_code=200,  # Auth success
@@ -186,7 +181,7 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
             "AUTH_FAILED",
             client_ip,
             {
-                "api_key": api_key_or_token[:8] + "..." if len(api_key_or_token) > 8 else api_key_or_token,
+                "api_key": mask_key(api_key_or_token),
                 "endpoint": request.url.path,
                 "auth_error": str(auth_error.detail)
             }
@@ -197,7 +192,7 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
             "AUTH_ERROR",
             client_ip,
             {
-                "api_key": api_key_or_token[:8] + "..." if len(api_key_or_token) > 8 else api_key_or_token,
+                "api_key": mask_key(api_key_or_token),
                 "endpoint": request.url.path,
                 "error": str(e)
             }
@@ -215,7 +210,7 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
             security_monitor.log_suspicious_activity(
                 "RATE_LIMIT_CONFIG_NOT_FOUND",
                 client_ip,
-                {"api_key": api_key[:8] + "..." if len(api_key) > 8 else api_key, "client_id": client_id}
+                {"api_key": masked_key, "client_id": client_id}
             )
             raise HTTPException(status_code=500, detail="Rate limit configuration not found")
         
@@ -225,7 +220,7 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
                 "CLIENT_ID_MISMATCH", 
                 client_ip,
                 {
-                    "api_key": api_key[:8] + "..." if len(api_key) > 8 else api_key,
+                    "api_key": cached_config.masked_key,
                     "auth_client_id": client_id,
                     "cached_client_id": cached_config.client_id
                 }
@@ -239,7 +234,7 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
             "RATE_LIMIT_CACHE_ERROR",
             client_ip,
             {
-                "api_key": api_key[:8] + "...",
+                "api_key": masked_key,
                 "client_id": client_id,
                 "error": str(e)
             }
@@ -255,42 +250,40 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
                 "ACCOUNT_INVALID",
                 client_ip,
                 {
-                    "api_key": api_key[:8] + "...",
+                    "api_key": cached_config.masked_key,
                     "client_id": client_id,
                     "reason": account_reason
                 }
             )
             raise HTTPException(status_code=403, detail=account_reason)
         
-        # Apply rate limits
-        can_proceed, rate_limit_reason = check_rate_limits_from_cache(cached_config)
+        # Apply rate limits (and record the request if it is admitted) - admin override keys
+        # are neither limited nor tracked, so they skip the usage windows entirely
+        if cached_config.override_all_limits:
+            can_proceed = True
+        else:
+            can_proceed, rate_limit_reason = admit_request(cached_config)
         
         if not can_proceed:
-            security_monitor.log_suspicious_activity(
-                "RATE_LIMIT_EXCEEDED",
+            limits = cached_config.get_rate_limits()
+            
+            # Immediate file logging + background database logging for rate limit violation
+            report_security_event(
+                request,
                 client_ip,
+                "RATE_LIMIT_EXCEEDED",
                 {
-                    "api_key": api_key[:8] + "...",
+                    "api_key": cached_config.masked_key,
                     "client_id": client_id,
                     "tier": cached_config.access_tier,
-                    "limit_reason": rate_limit_reason
-                }
-            )
-            
-            # Schedule background database logging for rate limit violation
-            add_security_event_to_request(
-                request,
-                "RATE_LIMIT_EXCEEDED",
+                    "limit_reason": rate_limit_reason,
+                    "limits": limits
+                },
                 api_key=api_key,
                 client_id=client_id,
                 event_description=f"Rate limit exceeded: {rate_limit_reason}",
                 response_code=429,
-                severity="MEDIUM",
-                event_data={
-                    "tier": cached_config.access_tier,
-                    "limit_reason": rate_limit_reason,
-                    "limits": cached_config.get_rate_limits()
-                }
+                severity="MEDIUM"
             )
             
             raise HTTPException(
@@ -299,13 +292,10 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
                     "error": "Rate limit exceeded",
                     "message": rate_limit_reason,
                     "tier": cached_config.access_tier,
-                    "limits": cached_config.get_rate_limits()
+                    "limits": limits
                 }
             )
         
-        # Record successful request
-        record_successful_request(cached_config)
-        
         # Log successful protection check
         response_time = time.time() - start_time
         security_monitor.log_api_usage(
@@ -325,13 +315,43 @@ async def comprehensive_api_protection(request: Request) -> CachedRateLimit:
             "RATE_LIMITING_ERROR",
             client_ip,
             {
-                "api_key": api_key[:8] + "...",
+                "api_key": cached_config.masked_key,
                 "client_id": client_id,
                 "error": str(e)
             }
         )
         raise HTTPException(status_code=500, detail="Rate limiting error")
 
+def _current_buckets() -> tuple[int, int, int]:
+    """(minute, hour, day) bucket numbers for now - whole units since the epoch, no datetime objects"""
+    now = int(time.time())
+    return now // 60, now // 3600, now // 86400
+
+def _new_windows() -> dict:
+    return {"minute": deque(), "hour": [0, 0], "day": [0, 0]}
+
+def _minute_count(requests: deque, now: float) -> int:
+    """Requests in the last 60 seconds (now: time.monotonic()); expired entries are dropped from the left"""
+    cutoff = now - 60
+    while requests and requests[0] <= cutoff:
+        requests.popleft()
+    return len(requests)
+
+def _window_count(window: list, bucket: int) -> int:
+    """
+    Requests counted for a [bucket, count] window - current bucket only (fixed window, as in
+    DatabaseQuotaManager); a stale bucket counts as 0
+    """
+    return window[1] if window[0] == bucket else 0
+
+def _window_add(window: list, bucket: int):
+    """Count one request in the window, starting a fresh count if the bucket has changed"""
+    if window[0] == bucket:
+        window[1] += 1
+    else:
+        window[0] = bucket
+        window[1] = 1
+
 def check_rate_limits_from_cache(cached_config: CachedRateLimit) -> tuple[bool, str]:
     """Check rate limits using cached configuration"""
     api_key = cached_config.api_key
@@ -340,41 +360,25 @@ def check_rate_limits_from_cache(cached_config: CachedRateLimit) -> tuple[bool,
     if cached_config.override_all_limits:
         return True, ""
     
-    now = datetime.now()
-    current_minute = now.replace(second=0, microsecond=0)
-    current_hour = now.replace(minute=0, second=0, microsecond=0)
-    current_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    # No requests recorded yet counts as zero, so a limit of 0 still rejects the first request
+    windows = usage_windows.get(api_key)
     
-    # Initialize tracking for this API key
-    if api_key not in usage_windows:
-        usage_windows[api_key] = {
-            "minute": [],
-            "hour": [],
-            "day": []
-        }
+    # Check minute limit first (sliding window) - the one most requests are rejected by
+    minute_count = 0 if windows is None else _minute_count(windows["minute"], time.monotonic())
+    if minute_count >= cached_config.minute_limit:
+        return False, f"Rate limit exceeded: {cached_config.minute_limit} requests per minute"
     
-    windows = usage_windows[api_key]
-    
-    # Clean old timestamps
-    cleanup_old_timestamps(windows, current_minute, current_hour, current_day)
-    
-    # Get limits from cached configuration
-    limits = cached_config.get_rate_limits()
-    
-    # Check minute limit
-    minute_count = len(windows["minute"])
-    if minute_count >= limits["requests_per_minute"]:
-        return False, f"Rate limit exceeded: {limits['requests_per_minute']} requests per minute"
+    _, hour, day = _current_buckets()
     
     # Check hour limit
-    hour_count = len(windows["hour"])
-    if hour_count >= limits["requests_per_hour"]:
-        return False, f"Rate limit exceeded: {limits['requests_per_hour']} requests per hour"
+    hour_count = 0 if windows is None else _window_count(windows["hour"], hour)
+    if hour_count >= cached_config.hour_limit:
+        return False, f"Rate limit exceeded: {cached_config.hour_limit} requests per hour"
     
     # Check day limit
-    day_count = len(windows["day"])
-    if day_count >= limits["requests_per_day"]:
-        return False, f"Rate limit exceeded: {limits['requests_per_day']} requests per day"
+    day_count = 0 if windows is None else _window_count(windows["day"], day)
+    if day_count >= cached_config.day_limit:
+        return False, f"Rate limit exceeded: {cached_config.day_limit} requests per day"
     
     return True, ""
 
@@ -385,76 +389,46 @@ def record_successful_request(cached_config: CachedRateLimit):
     if cached_config.override_all_limits:
         return  # Skip tracking for unlimited accounts
     
-    now = datetime.now()
-    current_minute = now.replace(second=0, microsecond=0)
-    current_hour = now.replace(minute=0, second=0, microsecond=0)
-    current_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    _, hour, day = _current_buckets()
     
     # Initialize if needed
-    if api_key not in usage_windows:
-        usage_windows[api_key] = {
-            "minute": [],
-            "hour": [], 
-            "day": []
-        }
+    windows = usage_windows.get(api_key)
+    if windows is None:
+        windows = usage_windows[api_key] = _new_windows()
     
-    windows = usage_windows[api_key]
+    # Count the request in each window
+    windows["minute"].append(time.monotonic())
+    _window_add(windows["hour"], hour)
+    _window_add(windows["day"], day)
     
-    # Record timestamps
-    windows["minute"].append(current_minute.isoformat())
-    windows["hour"].append(current_hour.isoformat())
-    windows["day"].append(current_day.isoformat())
-    
-    # Update database usage stats asynchronously
-    import asyncio
-    try:
-        from .db_access_control import update_usage_stats
-        asyncio.create_task(update_usage_stats(api_key, success=True))
-    except Exception:
-        pass  # Don't fail request if usage stats update fails
+    # Counted in memory; database usage stats are written in batches by a background flusher
+    record_usage(api_key)
 
-def cleanup_old_timestamps(windows, current_minute, current_hour, current_day):
-    """Remove old timestamps to prevent memory leaks"""
-    minute_cutoff = current_minute - timedelta(minutes=2)
-    hour_cutoff = current_hour - timedelta(hours=2)
-    day_cutoff = current_day - timedelta(days=2)
-    
-    # Clean minute window
-    windows["minute"] = [
-        ts for ts in windows["minute"]
-        if datetime.fromisoformat(ts) > minute_cutoff
-    ]
+def admit_request(cached_config: CachedRateLimit) -> tuple[bool, str]:
+    """
+    Check the rate limits and record the request if it is allowed, as one synchronous step.
+    Nothing awaits between the check and the record, so concurrent requests on the event loop
+    cannot both pass a limit with one slot left - no lock is needed.
+    """
+    can_proceed, reason = check_rate_limits_from_cache(cached_config)
+    if can_proceed:
+        record_successful_request(cached_config)
+    return can_proceed, reason
+
+def get_memory_usage_data(limit: Optional[int] = None, offset: int = 0) -> dict:
+    """Get in-memory usage tracking data for debugging (optionally one page of keys)"""
+    # Clock and bucket numbers are the same for every key - read them once per call
+    now = time.monotonic()
+    _, hour, day = _current_buckets()
     
-    # Clean hour window  
-    windows["hour"] = [
-        ts for ts in windows["hour"]
-        if datetime.fromisoformat(ts) > hour_cutoff
-    ]
+    # Snapshot first so formatting never iterates the live dict
+    snapshot = list(islice(usage_windows.items(), offset, None if limit is None else offset + limit))
     
-    # Clean day window
-    windows["day"] = [
-        ts for ts in windows["day"]
-        if datetime.fromisoformat(ts) > day_cutoff
-    ]
-
-def get_memory_usage_data() -> dict:
-    """Get all in-memory usage tracking data for debugging"""
-    memory_data = {}
-    for api_key, windows in usage_windows.items():
-        # Clean up first
-        now = datetime.now()
-        current_minute = now.replace(second=0, microsecond=0)
-        current_hour = now.replace(minute=0, second=0, microsecond=0)
-        current_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        cleanup_old_timestamps(windows, current_minute, current_hour, current_day)
-        
-        memory_data[api_key[:8] + "..."] = {
-            "minute_requests": len(windows["minute"]),
-            "hour_requests": len(windows["hour"]),
-            "day_requests": len(windows["day"]),
-            "recent_minute_timestamps": [
-                datetime.fromisoformat(ts).strftime("%H:%M:%S") 
-                for ts in windows["minute"][-5:]  # Last 5
-            ]
+    return {
+        mask_key(api_key): {
+            "minute_requests": _minute_count(windows["minute"], now),
+            "hour_requests": _window_count(windows["hour"], hour),
+            "day_requests": _window_count(windows["day"], day)
         }
-    return memory_data
+        for api_key, windows in snapshot
+    }
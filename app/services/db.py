@@ -1,25 +1,37 @@
 import json
 import os
+import threading
 import urllib.parse
 from pathlib import Path
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 
 _engine: Engine | None = None
+# Guards the first create_engine, so concurrent first callers (threads at startup) share one pool
+_engine_lock = threading.Lock()
 
-def get_engine() -> Engine:
-    global _engine
-    if _engine is not None:
-        return _engine
+# Shared by both connection paths: one long-lived pool for every request and background writer.
+# fast_executemany makes pyodbc send batched INSERTs (log writers) as one parameter array.
+# LIFO checkout keeps reusing the most recent connections, so the extras go idle in quiet periods
+# and are recycled instead of all staying warm. Sizes can be tuned per deployment.
+_ENGINE_OPTIONS = dict(
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_POOL_MAX_OVERFLOW", "10")),
+    pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    pool_use_lifo=True,
+    pool_pre_ping=True,
+    fast_executemany=True,
+)
 
+def _connection_url() -> str:
+    """Build the pyodbc URL from the environment or db_config.json (read once, when the engine is created)"""
     # Check if running in Azure (connection string takes precedence)
     azure_conn_string = os.getenv("api_db_conn")
     if azure_conn_string:
         # Azure uses direct connection string
-        connection_url = f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(azure_conn_string)}"
-        _engine = create_engine(connection_url, echo=False, pool_pre_ping=True)
-        return _engine
-    
+        return f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(azure_conn_string)}"
+
     # Check for individual Azure environment variables (alternative method)
     azure_server = os.getenv("AZURE_SQL_SERVER")
     if azure_server:
@@ -58,6 +70,16 @@ def get_engine() -> Engine:
         f"TrustServerCertificate={tsc};"
     )
 
-    conn_str = f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(odbc_str)}"
-    _engine = create_engine(conn_str, pool_pre_ping=True, pool_recycle=1800)
+    return f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(odbc_str)}"
+
+def get_engine() -> Engine:
+    global _engine
+    # Fast path: no lock once the engine exists
+    if _engine is not None:
+        return _engine
+
+    with _engine_lock:
+        # Another caller may have created it while we waited
+        if _engine is None:
+            _engine = create_engine(_connection_url(), echo=False, **_ENGINE_OPTIONS)
     return _engine
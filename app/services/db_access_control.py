@@ -7,9 +7,22 @@ from sqlalchemy import text
 from typing import Dict, Any, Optional, List
 from datetime import datetime, timedelta
 import json
+import re
+import asyncio
 from .db import get_engine
 from .error_codes import ErrorCode, get_error_response
 
+# client_api_access columns loaded into ClientAPIAccess (shared with the fused account lookups)
+CLIENT_API_ACCESS_COLUMNS = (
+    "access_id", "client_id", "api_key",
+    "requests_per_minute", "requests_per_hour", "requests_per_day",
+    "access_tier", "is_active", "is_suspended", "suspension_reason", "suspended_until",
+    "total_requests_lifetime", "requests_today", "last_request_at",
+    "failed_auth_attempts", "is_auto_blocked", "auto_block_reason",
+    "allowed_endpoints", "blocked_endpoints", "burst_requests_allowed",
+    "override_all_limits", "created_at", "updated_at",
+)
+
 class ClientAPIAccess:
     """Client API access configuration from database"""
     
@@ -49,6 +62,9 @@ class ClientAPIAccess:
         # Endpoint restrictions
         self.allowed_endpoints = self._parse_json_field(db_row.get('allowed_endpoints'))
         self.blocked_endpoints = self._parse_json_field(db_row.get('blocked_endpoints'))
+        # Each list as one anchored prefix regex, so the per-request check is a single C-level match
+        self._allowed_re = self._prefix_pattern(self.allowed_endpoints)
+        self._blocked_re = self._prefix_pattern(self.blocked_endpoints)
         
         # Timestamps
         self.created_at = db_row.get('created_at')
@@ -65,6 +81,13 @@ class ClientAPIAccess:
         except (json.JSONDecodeError, TypeError):
             return None
     
+    @staticmethod
+    def _prefix_pattern(prefixes: Optional[List[str]]) -> Optional[re.Pattern]:
+        """Regex matching any endpoint that starts with one of prefixes (None if there are none)"""
+        if not prefixes:
+            return None
+        return re.compile("(?:" + "|".join(re.escape(str(prefix)) for prefix in prefixes) + ")")
+    
     def is_account_valid(self) -> tuple[bool, str]:
         """Check if account can make API requests"""
         if not self.is_active:
@@ -93,18 +116,13 @@ class ClientAPIAccess:
     
     def can_access_endpoint(self, endpoint: str) -> bool:
         """Check if client can access specific endpoint"""
-        # Check blocked endpoints first
-        if self.blocked_endpoints:
-            for blocked in self.blocked_endpoints:
-                if endpoint.startswith(blocked) or endpoint == blocked:
-                    return False
+        # Check blocked endpoints first (prefix match - re.match anchors at the start)
+        if self._blocked_re is not None and self._blocked_re.match(endpoint):
+            return False
         
         # Check allowed endpoints (if specified, only these are allowed)
-        if self.allowed_endpoints:
-            for allowed in self.allowed_endpoints:
-                if endpoint.startswith(allowed) or endpoint == allowed:
-                    return True
-            return False  # Not in allowed list
+        if self._allowed_re is not None:
+            return self._allowed_re.match(endpoint) is not None
         
         return True  # No restrictions
     
@@ -124,39 +142,31 @@ class ClientAPIAccess:
             "burst_requests_allowed": self.burst_requests_allowed
         }
 
+# Query to get comprehensive API access info - matching your actual table structure (built once at import)
+_SELECT_CLIENT_API_ACCESS = text(f"""
+    SELECT {", ".join(CLIENT_API_ACCESS_COLUMNS)}
+    FROM app.client_api_access 
+    WHERE api_key = :api_key
+""")
+
+def _select_client_api_access(api_key: str):
+    """Blocking pyodbc round-trip - called through asyncio.to_thread. Single read, so autocommit."""
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        return conn.execute(_SELECT_CLIENT_API_ACCESS, {"api_key": api_key}).mappings().first()
+
 async def get_client_api_access(api_key: str) -> ClientAPIAccess:
-    """Get client API access configuration from database"""
+    """Get client API access configuration from database (the query runs in a worker thread)"""
     if not api_key:
         raise ValueError("API key is required")
     
-    engine = get_engine()
-    
-    # Query to get comprehensive API access info - matching your actual table structure
-    sql = text("""
-        SELECT 
-            access_id, client_id, api_key,
-            requests_per_minute, requests_per_hour, requests_per_day,
-            access_tier, is_active, is_suspended, suspension_reason, suspended_until,
-            total_requests_lifetime, requests_today, last_request_at,
-            failed_auth_attempts, is_auto_blocked, auto_block_reason,
-            allowed_endpoints, blocked_endpoints, burst_requests_allowed,
-            override_all_limits, created_at, updated_at
-        FROM app.client_api_access 
-        WHERE api_key = :api_key
-    """)
-    
     try:
-        with engine.connect() as conn:
-            result = conn.execute(sql, {"api_key": api_key}).first()
-            
-            if not result:
-                raise ValueError("Invalid API key")
-            
-            # Convert row to structure matching your actual table
-            row_dict = dict(result._mapping)
-            
-            # Create ClientAPIAccess with your actual database fields
-            return ClientAPIAccess(row_dict)
+        row = await asyncio.to_thread(_select_client_api_access, api_key)
+        
+        if not row:
+            raise ValueError("Invalid API key")
+        
+        # Create ClientAPIAccess with your actual database fields
+        return ClientAPIAccess(dict(row))
             
     except ValueError:
         # Re-raise validation errors
@@ -169,48 +179,94 @@ async def get_client_api_access(api_key: str) -> ClientAPIAccess:
         else:
             raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-async def update_usage_stats(api_key: str, success: bool = True):
-    """Update usage statistics in database"""
-    engine = get_engine()
-    
+# Usage stats (successful requests and failed auth attempts) are counted in memory and written by
+# one flusher task, not an UPDATE per request
+_UPDATE_USAGE_STATS_BATCH = text("""
+    UPDATE app.client_api_access 
+    SET total_requests_lifetime = total_requests_lifetime + :n,
+        requests_today = requests_today + :n,
+        last_request_at = GETDATE(),
+        updated_at = GETDATE()
+    WHERE api_key = :api_key
+""")
+_UPDATE_FAILED_AUTH_BATCH = text("""
+    UPDATE app.client_api_access 
+    SET failed_auth_attempts = failed_auth_attempts + :n,
+        updated_at = GETDATE()
+    WHERE api_key = :api_key
+""")
+USAGE_FLUSH_INTERVAL = 5  # seconds between batched usage-stats writes
+_pending_usage: Dict[str, int] = {}
+_pending_failed: Dict[str, int] = {}
+_usage_flusher: Optional[asyncio.Task] = None
+
+def _write_usage_deltas(usage_rows: List[Dict[str, Any]], failed_rows: List[Dict[str, Any]]):
+    """Blocking: apply all per-key deltas in one transaction (run in a worker thread)"""
+    with get_engine().begin() as conn:
+        if usage_rows:
+            conn.execute(_UPDATE_USAGE_STATS_BATCH, usage_rows)
+        if failed_rows:
+            conn.execute(_UPDATE_FAILED_AUTH_BATCH, failed_rows)
+
+async def flush_usage_stats():
+    """
+    Write the pending usage counts now - one executemany UPDATE per counter for every key seen
+    since the last flush (fast_executemany sends each as a single parameter array)
+    """
+    global _pending_usage, _pending_failed
+    if not _pending_usage and not _pending_failed:
+        return
+    usage, _pending_usage = _pending_usage, {}
+    failed, _pending_failed = _pending_failed, {}
     try:
-        with engine.begin() as conn:
-            if success:
-                # Successful request - update counters
-                conn.execute(text("""
-                    UPDATE app.client_api_access 
-                    SET total_requests_lifetime = total_requests_lifetime + 1,
-                        requests_today = requests_today + 1,
-                        last_request_at = GETDATE(),
-                        updated_at = GETDATE()
-                    WHERE api_key = :api_key
-                """), {"api_key": api_key})
-            else:
-                # Failed request - update failed auth attempts
-                conn.execute(text("""
-                    UPDATE app.client_api_access 
-                    SET failed_auth_attempts = failed_auth_attempts + 1,
-                        updated_at = GETDATE()
-                    WHERE api_key = :api_key
-                """), {"api_key": api_key})
-                
+        await asyncio.to_thread(
+            _write_usage_deltas,
+            [{"api_key": k, "n": n} for k, n in usage.items()],
+            [{"api_key": k, "n": n} for k, n in failed.items()]
+        )
     except Exception as e:
-        # Log error but don't fail the request
-        print(f"Warning: Could not update usage stats for {api_key}: {e}")
+        # Put the counts back (adding anything recorded meanwhile) so the next flush retries them
+        for api_key, n in usage.items():
+            _pending_usage[api_key] = _pending_usage.get(api_key, 0) + n
+        for api_key, n in failed.items():
+            _pending_failed[api_key] = _pending_failed.get(api_key, 0) + n
+        # Log error but don't fail the application
+        print(f"Warning: Could not update usage stats for {len(usage.keys() | failed.keys())} API keys, will retry: {e}")
+
+async def _usage_stats_flusher():
+    """Long-lived task that writes pending usage counts every USAGE_FLUSH_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        await flush_usage_stats()
+
+def record_usage(api_key: str, success: bool = True):
+    """
+    Count a successful request (or, with success=False, a failed auth attempt) toward the next
+    batched usage-stats write. Non-blocking; the flusher task is started on first use.
+    """
+    global _usage_flusher
+    if _usage_flusher is None or _usage_flusher.done():
+        _usage_flusher = asyncio.create_task(_usage_stats_flusher())
+    pending = _pending_usage if success else _pending_failed
+    pending[api_key] = pending.get(api_key, 0) + 1
+
+_AUTO_BLOCK_API_KEY = text("""
+    UPDATE app.client_api_access 
+    SET is_auto_blocked = 1,
+        auto_block_reason = :reason,
+        updated_at = GETDATE()
+    WHERE api_key = :api_key
+""")
+
+def _write_auto_block(api_key: str, reason: str):
+    """Blocking: mark the key auto-blocked (run in a worker thread)"""
+    with get_engine().begin() as conn:
+        conn.execute(_AUTO_BLOCK_API_KEY, {"api_key": api_key, "reason": reason})
 
 async def auto_block_api_key(api_key: str, reason: str):
     """Auto-block an API key due to suspicious activity"""
-    engine = get_engine()
-    
     try:
-        with engine.begin() as conn:
-            conn.execute(text("""
-                UPDATE app.client_api_access 
-                SET is_auto_blocked = 1,
-                    auto_block_reason = :reason,
-                    updated_at = GETDATE()
-                WHERE api_key = :api_key
-            """), {"api_key": api_key, "reason": reason})
+        await asyncio.to_thread(_write_auto_block, api_key, reason)
             
         print(f"Auto-blocked API key {api_key[:8]}... due to: {reason}")
         
@@ -232,7 +288,7 @@ async def resolve_client_with_db_access_control(request: Request) -> ClientAPIAc
         is_valid, reason = client_access.is_account_valid()
         if not is_valid:
             # Log failed authentication attempt
-            await update_usage_stats(api_key, success=False)
+            record_usage(api_key, success=False)
             raise HTTPException(status_code=403, detail=reason)
         
         # Check endpoint access (if restrictions are configured)
@@ -250,7 +306,7 @@ async def resolve_client_with_db_access_control(request: Request) -> ClientAPIAc
         raise
     except ValueError as e:
         # Invalid API key
-        await update_usage_stats(api_key, success=False)
+        record_usage(api_key, success=False)
         raise HTTPException(status_code=401, detail=str(e))
     except Exception as e:
         # Database or other errors
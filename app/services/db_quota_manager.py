@@ -3,18 +3,73 @@ Database-driven quota management with intelligent caching
 Uses client_api_access table for dynamic rate limiting with smart cache management
 """
 from fastapi import HTTPException, Request
-from typing import Dict, Optional
-from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
 import time
 from .rate_limit_cache import rate_limit_cache, CachedRateLimit
-from .db_access_control import ClientAPIAccess, resolve_client_with_db_access_control, update_usage_stats
+from .db_access_control import ClientAPIAccess, resolve_client_with_db_access_control, record_usage
 from .security_monitor import security_monitor
 from .security_event_logger import security_logger
+from ..middleware.security_logging_middleware import get_client_ip
 import asyncio
 
-# In-memory usage tracking for rate limiting windows
-# Format: {api_key: {minute: [], hour: [], day: []}}
-usage_windows: Dict[str, Dict[str, list]] = {}
+class TokenBucket:
+    """
+    Per-key minute limiter: refills at requests_per_minute / 60 tokens a second up to cap
+    (requests_per_minute plus burst_requests_allowed extra requests).
+    Refilled lazily on each check, so an idle key costs nothing.
+    """
+    __slots__ = ("tokens", "last", "rate", "cap")
+    
+    def __init__(self, rate: float, cap: float, now: float):
+        self.rate = rate
+        self.cap = cap
+        self.tokens = cap
+        self.last = now
+    
+    def refill(self, now: float) -> float:
+        """Add the tokens earned since the last refill (now: time.monotonic()) and return the balance"""
+        self.tokens = min(self.cap, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return self.tokens
+
+# In-memory usage tracking for rate limiting - the minute limit is a token bucket per key,
+# hour and day are fixed-window counters, all O(1) per key
+# Format: {api_key: TokenBucket}
+minute_buckets: Dict[str, TokenBucket] = {}
+# Format: {api_key: (hour_bucket, hour_count, day_bucket, day_count)}
+# Buckets are whole hours/days since the epoch; a count only applies while its bucket is current.
+usage_windows: Dict[str, Tuple[int, int, int, int]] = {}
+_NO_USAGE = (0, 0, 0, 0)
+
+def _current_buckets() -> Tuple[int, int]:
+    """(hour, day) bucket numbers for now - integer math, no datetime objects"""
+    now = int(time.time())
+    return now // 3600, now // 86400
+
+def _usage_counts(api_key: str, hour: int, day: int) -> Tuple[int, int]:
+    """(hour, day) request counts for the given buckets; a stale bucket counts as 0"""
+    hour_bucket, hour_count, day_bucket, day_count = usage_windows.get(api_key, _NO_USAGE)
+    return (
+        hour_count if hour_bucket == hour else 0,
+        day_count if day_bucket == day else 0
+    )
+
+def _minute_bucket(cached_config: CachedRateLimit, now: float) -> TokenBucket:
+    """The key's token bucket, created full on first use; rate and cap follow the current cached limits"""
+    per_minute = cached_config.get_rate_limits()["requests_per_minute"]
+    rate = per_minute / 60
+    # Burst is extra requests on top of the minute limit, not a replacement for it
+    cap = per_minute + (cached_config.burst_requests_allowed or 0)
+    bucket = minute_buckets.get(cached_config.api_key)
+    if bucket is None:
+        bucket = minute_buckets[cached_config.api_key] = TokenBucket(rate, cap, now)
+    else:
+        bucket.refill(now)
+        bucket.rate = rate
+        bucket.cap = cap
+        if bucket.tokens > cap:
+            bucket.tokens = cap
+    return bucket
 
 class DatabaseQuotaManager:
     """Quota manager using database-driven limits with intelligent caching"""
@@ -40,115 +95,60 @@ class DatabaseQuotaManager:
         if cached_config.override_all_limits:
             return True, "", cached_config
         
-        now = datetime.now()
-        current_minute = now.replace(second=0, microsecond=0)
-        current_hour = now.replace(minute=0, second=0, microsecond=0)
-        current_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Initialize tracking for this API key
-        if api_key not in usage_windows:
-            usage_windows[api_key] = {
-                "minute": [],
-                "hour": [],
-                "day": []
-            }
-        
-        windows = usage_windows[api_key]
-        
-        # Clean old timestamps
-        self._cleanup_old_timestamps(windows, current_minute, current_hour, current_day)
+        # Counts for the current buckets (nothing to clean up - stale buckets just read as 0)
+        hour_count, day_count = _usage_counts(api_key, *_current_buckets())
         
         # Get limits from cached configuration
         limits = cached_config.get_rate_limits()
         
-        # Check minute limit
-        minute_count = len(windows["minute"])
-        if minute_count >= limits["requests_per_minute"]:
+        # Check minute limit (token bucket - allows configured bursts, no 2x burst across a minute boundary)
+        if _minute_bucket(cached_config, time.monotonic()).tokens < 1:
             return False, f"Rate limit exceeded: {limits['requests_per_minute']} requests per minute", cached_config
         
         # Check hour limit
-        hour_count = len(windows["hour"])
         if hour_count >= limits["requests_per_hour"]:
             return False, f"Rate limit exceeded: {limits['requests_per_hour']} requests per hour", cached_config
         
         # Check day limit
-        day_count = len(windows["day"])
         if day_count >= limits["requests_per_day"]:
             return False, f"Rate limit exceeded: {limits['requests_per_day']} requests per day", cached_config
         
         return True, "", cached_config
     
     def record_request_cached(self, cached_config: CachedRateLimit):
-        """Record a successful API request using cached config"""
+        """
+        Record a successful API request using cached config.
+        Synchronous, and each key's counters are replaced in one assignment, so a concurrent
+        reader never sees a half-updated window.
+        """
         api_key = cached_config.api_key
         
         if cached_config.override_all_limits:
             return  # Skip tracking for unlimited accounts
         
-        now = datetime.now()
-        current_minute = now.replace(second=0, microsecond=0)
-        current_hour = now.replace(minute=0, second=0, microsecond=0)
-        current_day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        # Spend a minute token
+        _minute_bucket(cached_config, time.monotonic()).tokens -= 1
         
-        # Initialize if needed
-        if api_key not in usage_windows:
-            usage_windows[api_key] = {
-                "minute": [],
-                "hour": [], 
-                "day": []
-            }
-        
-        windows = usage_windows[api_key]
+        hour, day = _current_buckets()
+        hour_count, day_count = _usage_counts(api_key, hour, day)
         
-        # Record timestamps
-        windows["minute"].append(current_minute.isoformat())
-        windows["hour"].append(current_hour.isoformat())
-        windows["day"].append(current_day.isoformat())
+        # Count the request, starting a fresh count for any bucket that has rolled over
+        usage_windows[api_key] = (hour, hour_count + 1, day, day_count + 1)
         
-        # Update database usage stats asynchronously (don't block the request)
-        import asyncio
-        try:
-            asyncio.create_task(update_usage_stats(api_key, success=True))
-        except Exception:
-            pass  # Don't fail request if usage stats update fails
-    
-    def _cleanup_old_timestamps(self, windows: Dict[str, list], current_minute, current_hour, current_day):
-        """Remove old timestamps to prevent memory leaks"""
-        minute_cutoff = current_minute - timedelta(minutes=2)
-        hour_cutoff = current_hour - timedelta(hours=2)
-        day_cutoff = current_day - timedelta(days=2)
-        
-        # Clean minute window
-        windows["minute"] = [
-            ts for ts in windows["minute"]
-            if datetime.fromisoformat(ts) > minute_cutoff
-        ]
-        
-        # Clean hour window  
-        windows["hour"] = [
-            ts for ts in windows["hour"]
-            if datetime.fromisoformat(ts) > hour_cutoff
-        ]
-        
-        # Clean day window
-        windows["day"] = [
-            ts for ts in windows["day"]
-            if datetime.fromisoformat(ts) > day_cutoff
-        ]
+        # Counted in memory; database usage stats are written in batches by a background flusher
+        record_usage(api_key)
     
     def get_usage_stats_cached(self, cached_config: CachedRateLimit) -> Dict:
         """Get current usage statistics using cached config"""
         api_key = cached_config.api_key
         
-        if api_key not in usage_windows:
-            current_usage = {"minute": 0, "hour": 0, "day": 0}
-        else:
-            windows = usage_windows[api_key]
-            current_usage = {
-                "minute": len(windows.get("minute", [])),
-                "hour": len(windows.get("hour", [])),
-                "day": len(windows.get("day", []))
-            }
+        hour_count, day_count = _usage_counts(api_key, *_current_buckets())
+        
+        # Minute usage is the part of the bucket currently spent
+        bucket = minute_buckets.get(api_key)
+        minute_count = int(bucket.cap - bucket.refill(time.monotonic())) if bucket else 0
+        
+        current_usage = {"minute": minute_count, "hour": hour_count, "day": day_count}
         
         limits = cached_config.get_rate_limits()
         
@@ -158,8 +158,8 @@ class DatabaseQuotaManager:
             "current_usage": current_usage,
             "limits": limits,
             "cache_info": {
-                "cached_at": cached_config.cached_at.isoformat(),
-                "last_refreshed": cached_config.last_refreshed.isoformat(),
+                "cached_at": cached_config.cached_at_iso,
+                "last_refreshed": cached_config.last_refreshed_iso,
                 "refresh_count": cached_config.refresh_count
             },
             "account_status": {
@@ -176,8 +176,7 @@ db_quota_manager = DatabaseQuotaManager()
 async def resolve_client_with_db_quota_check_cached(request: Request) -> CachedRateLimit:
     """Enhanced authentication with cached database-driven quota checking"""
     start_time = time.time()
-    client_ip = request.headers.get("x-forwarded-for", 
-                                  request.client.host if request.client else "unknown")
+    client_ip = get_client_ip(request)
     
     # Get API key from request
     api_key = request.query_params.get("key")
@@ -243,7 +242,8 @@ async def resolve_client_with_db_quota_check_cached(request: Request) -> CachedR
                 }
             )
         
-        # Record the successful request
+        # Record the successful request - nothing awaits between the limit check returning and this
+        # call, so concurrent requests on the event loop cannot both take the last slot (no lock needed)
         db_quota_manager.record_request_cached(cached_config)
         
         # Log successful API usage
@@ -2,20 +2,42 @@
 IP-based Brutal Attack Protection
 Tracks IP requests regardless of call structure validation
 """
-from typing import Dict, List
-from datetime import datetime, timedelta
+from typing import Dict, Deque, List, Optional
+from collections import deque
+from itertools import islice
+from datetime import datetime
 import json
 import os
 import threading
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from .security_event_logger import security_logger
 import asyncio
 
+def _monotonic_to_datetime(timestamp: float, offset: float = None) -> datetime:
+    """
+    Convert a time.monotonic() timestamp to wall-clock time (for display only).
+    Pass offset (time.time() - time.monotonic()) when converting many timestamps at once.
+    """
+    if offset is None:
+        offset = time.time() - time.monotonic()
+    return datetime.fromtimestamp(offset + timestamp)
+
+IDLE_SWEEP_INTERVAL = 60  # seconds between idle-IP sweeps
+IDLE_SWEEP_CHUNK = 1000  # IPs checked per event-loop turn during a sweep
+
+def _mask_ip(ip_address: str) -> str:
+    """Mask an IP for display: a.b.x.x for dotted-quad IPv4, first 8 chars otherwise"""
+    # Four parts means three dots; keep everything before the second dot (no list allocation)
+    if ip_address.count('.') == 3:
+        return f"{ip_address[:ip_address.find('.', ip_address.find('.') + 1)]}.x.x"
+    return f"{ip_address[:8]}..."
+
 @dataclass
 class IPTrackingInfo:
     """IP tracking information for brutal attack detection"""
     ip_address: str
-    requests_in_minute: List[datetime]
+    requests_in_minute: Deque[float]  # time.monotonic() timestamps
     total_requests: int
     first_seen: datetime
     last_request: datetime
@@ -23,13 +45,18 @@ class IPTrackingInfo:
     block_reason: str
     block_timestamp: datetime = None
     
-    def cleanup_old_requests(self):
-        """Remove requests older than 1 minute"""
-        cutoff = datetime.now() - timedelta(minutes=1)
-        self.requests_in_minute = [
-            req_time for req_time in self.requests_in_minute 
-            if req_time > cutoff
-        ]
+    # Display form of ip_address (a.b.x.x for IPv4), computed once when tracking starts
+    masked_ip: str = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self.masked_ip = _mask_ip(self.ip_address)
+    
+    def cleanup_old_requests(self, now: float = None):
+        """Remove requests older than 1 minute (now: time.monotonic(), read once by bulk callers)"""
+        cutoff = (time.monotonic() if now is None else now) - 60
+        requests = self.requests_in_minute
+        while requests and requests[0] <= cutoff:
+            requests.popleft()
     
     def get_requests_in_last_minute(self) -> int:
         """Get count of requests in last minute"""
@@ -48,6 +75,11 @@ class IPBrutalAttackTracker:
         self._ip_tracking: Dict[str, IPTrackingInfo] = {}
         self.blocked_ips_file = "blocked_ips.json"
         self.brutal_attack_threshold = 50  # requests per minute
+        # Running count of blocked entries, kept in step with every block/unblock (no scans)
+        self._blocked_count = 0
+        # Idle IPs are swept out once per window by a background task, so the dict stays bounded by
+        # recent traffic without any request paying for the scan (started on first tracked request)
+        self._idle_sweeper: asyncio.Task = None
         self._load_blocked_ips()
     
     def _load_blocked_ips(self):
@@ -71,7 +103,7 @@ class IPBrutalAttackTracker:
                                 if isinstance(data, dict):  # Ensure data is a dict
                                     self._ip_tracking[ip] = IPTrackingInfo(
                                         ip_address=ip,
-                                        requests_in_minute=[],
+                                        requests_in_minute=deque(),
                                         total_requests=data.get('total_requests', 0),
                                         first_seen=datetime.fromisoformat(data.get('first_seen', datetime.now().isoformat())),
                                         last_request=datetime.fromisoformat(data.get('last_request', datetime.now().isoformat())),
@@ -79,6 +111,7 @@ class IPBrutalAttackTracker:
                                         block_reason=data.get('block_reason', ''),
                                         block_timestamp=datetime.fromisoformat(data['block_timestamp']) if data.get('block_timestamp') else None
                                     )
+                            self._blocked_count = sum(1 for info in self._ip_tracking.values() if info.is_blocked)
         except Exception as e:
             print(f"Warning: Could not load blocked IPs: {e}")
     
@@ -108,12 +141,17 @@ class IPBrutalAttackTracker:
         This is called for EVERY request regardless of structure validation
         """
         now = datetime.now()
+        tick = time.monotonic()
+        
+        if self._idle_sweeper is None or self._idle_sweeper.done():
+            self._start_idle_sweeper()
         
-        # Initialize IP tracking if not exists
-        if ip_address not in self._ip_tracking:
-            self._ip_tracking[ip_address] = IPTrackingInfo(
+        # One dict lookup; initialize IP tracking if not exists
+        ip_info = self._ip_tracking.get(ip_address)
+        if ip_info is None:
+            ip_info = self._ip_tracking[ip_address] = IPTrackingInfo(
                 ip_address=ip_address,
-                requests_in_minute=[now],
+                requests_in_minute=deque([tick]),
                 total_requests=1,
                 first_seen=now,
                 last_request=now,
@@ -122,22 +160,20 @@ class IPBrutalAttackTracker:
             )
         else:
             # Update existing IP info
-            ip_info = self._ip_tracking[ip_address]
-            ip_info.requests_in_minute.append(now)
+            ip_info.requests_in_minute.append(tick)
             ip_info.total_requests += 1
             ip_info.last_request = now
-            ip_info.cleanup_old_requests()
-        
-        ip_info = self._ip_tracking[ip_address]
+            ip_info.cleanup_old_requests(tick)
         
         # Check if already blocked
         if ip_info.is_blocked:
             return True
         
-        # Check if should be blocked due to brutal usage
-        if ip_info.should_be_blocked(self.brutal_attack_threshold):
+        # Check if should be blocked due to brutal usage (window already trimmed above)
+        requests_count = len(ip_info.requests_in_minute)
+        if requests_count >= self.brutal_attack_threshold:
             ip_info.is_blocked = True
-            requests_count = ip_info.get_requests_in_last_minute()
+            self._blocked_count += 1
             ip_info.block_reason = f"Brutal attack: {requests_count} requests in 1 minute"
             ip_info.block_timestamp = now
             self._save_blocked_ips()
@@ -193,6 +229,36 @@ class IPBrutalAttackTracker:
         
         return False
     
+    def _start_idle_sweeper(self):
+        """Start the idle-IP sweeper on the running event loop (no loop - nothing to start yet)"""
+        try:
+            self._idle_sweeper = asyncio.get_running_loop().create_task(self._idle_ip_sweeper())
+        except RuntimeError:
+            pass
+    
+    async def _idle_ip_sweeper(self):
+        """
+        Long-lived task: every IDLE_SWEEP_INTERVAL seconds, evict idle IPs a chunk at a time,
+        yielding to the event loop between chunks so no request waits on a full scan
+        """
+        while True:
+            await asyncio.sleep(IDLE_SWEEP_INTERVAL)
+            ips = list(self._ip_tracking)
+            for start in range(0, len(ips), IDLE_SWEEP_CHUNK):
+                self._evict_idle_ips(ips[start:start + IDLE_SWEEP_CHUNK], time.monotonic())
+                await asyncio.sleep(0)
+    
+    def _evict_idle_ips(self, ips: List[str], now: float):
+        """Drop the given IPs if unblocked with no requests in the last minute (blocked IPs stay until unblocked)"""
+        tracking = self._ip_tracking
+        for ip in ips:
+            ip_info = tracking.get(ip)
+            if ip_info is None or ip_info.is_blocked:
+                continue
+            ip_info.cleanup_old_requests(now)
+            if not ip_info.requests_in_minute:
+                del tracking[ip]
+    
     def is_ip_blocked(self, ip_address: str) -> tuple[bool, str]:
         """Check if IP is blocked"""
         if ip_address in self._ip_tracking:
@@ -221,16 +287,15 @@ class IPBrutalAttackTracker:
         # Return all IPs summary
         stats = {
             "total_tracked_ips": len(self._ip_tracking),
-            "blocked_ips": 0,
+            "blocked_ips": self._blocked_count,
             "active_ips_last_minute": 0,
             "brutal_attack_threshold": self.brutal_attack_threshold
         }
         
-        for ip_info in self._ip_tracking.values():
-            ip_info.cleanup_old_requests()
-            if ip_info.is_blocked:
-                stats["blocked_ips"] += 1
-            if ip_info.get_requests_in_last_minute() > 0:
+        now = time.monotonic()
+        for ip_info in list(self._ip_tracking.values()):
+            ip_info.cleanup_old_requests(now)
+            if ip_info.requests_in_minute:
                 stats["active_ips_last_minute"] += 1
         
         return stats
@@ -238,6 +303,8 @@ class IPBrutalAttackTracker:
     def unblock_ip(self, ip_address: str) -> bool:
         """Manually unblock an IP"""
         if ip_address in self._ip_tracking:
+            if self._ip_tracking[ip_address].is_blocked:
+                self._blocked_count -= 1
             self._ip_tracking[ip_address].is_blocked = False
             self._ip_tracking[ip_address].block_reason = ""
             self._ip_tracking[ip_address].block_timestamp = None
@@ -246,14 +313,44 @@ class IPBrutalAttackTracker:
             return True
         return False
     
-    def get_memory_data(self) -> Dict:
-        """Get all in-memory IP tracking data for debugging"""
-        memory_data = {}
-        for ip, info in self._ip_tracking.items():
-            info.cleanup_old_requests()
-            memory_data[ip] = {
+    def reset(self):
+        """
+        Forget all tracked IPs (including brutal-attack blocks) in one step.
+        The dict is replaced rather than cleared so in-flight snapshots stay valid.
+        """
+        self._ip_tracking = {}
+        self._blocked_count = 0
+    
+    def forget_ip(self, ip_address: str) -> bool:
+        """Stop tracking an IP entirely (dropping any block on it)"""
+        ip_info = self._ip_tracking.pop(ip_address, None)
+        if ip_info is None:
+            return False
+        if ip_info.is_blocked:
+            self._blocked_count -= 1
+        return True
+    
+    @property
+    def blocked_count(self) -> int:
+        """Number of currently blocked IPs - O(1)"""
+        return self._blocked_count
+    
+    def get_memory_data(self, limit: Optional[int] = None, offset: int = 0) -> Dict:
+        """Get in-memory IP tracking data for debugging (optionally one page of IPs)"""
+        now = time.monotonic()
+        clock_offset = time.time() - now
+        snapshot = list(islice(self._ip_tracking.items(), offset, None if limit is None else offset + limit))
+        for _, info in snapshot:
+            info.cleanup_old_requests(now)
+        
+        return {
+            ip: {
+                "masked_ip": info.masked_ip,
                 "requests_in_minute_count": len(info.requests_in_minute),
-                "requests_timestamps": [t.isoformat() for t in info.requests_in_minute[-5:]],  # Last 5
+                "requests_timestamps": [
+                    _monotonic_to_datetime(t, clock_offset).isoformat()
+                    for t in islice(info.requests_in_minute, max(len(info.requests_in_minute) - 5, 0), None)  # Last 5
+                ],
                 "total_requests": info.total_requests,
                 "first_seen": info.first_seen.isoformat(),
                 "last_request": info.last_request.isoformat(),
@@ -261,7 +358,8 @@ class IPBrutalAttackTracker:
                 "block_reason": info.block_reason,
                 "block_timestamp": info.block_timestamp.isoformat() if info.block_timestamp else None
             }
-        return memory_data
+            for ip, info in snapshot
+        }
 
 # Global IP tracker instance
 ip_brutal_tracker = IPBrutalAttackTracker()
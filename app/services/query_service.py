@@ -374,16 +374,11 @@ def run_saved_query(
             raise_coded_error(ErrorCode.QUERY_PROCESSING_FAILED)
 
         # Convert result to list of dicts and handle datetime serialization
-        result_rows = []
-        for row in rows:
-            row_dict = {}
-            for key, value in row.items():
-                # Convert datetime objects to ISO format strings for JSON serialization
-                if hasattr(value, 'isoformat'):  # datetime, date, time objects
-                    row_dict[key] = value.isoformat()
-                else:
-                    row_dict[key] = value
-            result_rows.append(row_dict)
+        # (datetime, date, time objects become ISO format strings for JSON serialization)
+        result_rows = [
+            {key: value.isoformat() if hasattr(value, 'isoformat') else value for key, value in row.items()}
+            for row in rows
+        ]
 
         # field order for CSV (optional)
         field_order = list(result_rows[0].keys()) if result_rows else []
@@ -8,6 +8,7 @@ import time
 from datetime import datetime, timedelta
 import json
 import os
+from ..middleware.security_logging_middleware import get_client_ip
 
 # In-memory usage tracking (consider Redis for production)
 usage_tracker: Dict[str, Dict] = {}
@@ -142,15 +143,9 @@ async def resolve_client_with_quota_check(request: Request) -> int:
             
     except Exception as e:
         # Track failed authentication by API key
-        client_ip = request.headers.get("x-forwarded-for", 
-                                      request.client.host if request.client else "unknown")
+        client_ip = get_client_ip(request)
         security_monitor.log_authentication_failure(client_ip, authorization[:16] + "..." if authorization else "None")
         
-        # Also track in IP blocking middleware for API key abuse
-        from ..middleware.ip_blocking import IPBlockingMiddleware
-        # Note: This would need access to the middleware instance
-        # For now, we'll rely on the security monitor
-        
         raise HTTPException(status_code=401, detail="Invalid API key")
     
     # Check quota before proceeding
@@ -160,8 +155,7 @@ async def resolve_client_with_quota_check(request: Request) -> int:
         minute_limit = quota_manager.minute_limits.get(client_tier, 2)
         
         # Log quota exceeded as suspicious activity
-        client_ip = request.headers.get("x-forwarded-for", 
-                                      request.client.host if request.client else "unknown")
+        client_ip = get_client_ip(request)
         security_monitor.log_suspicious_activity(
             "QUOTA_EXCEEDED",
             client_ip,
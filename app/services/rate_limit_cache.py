@@ -2,15 +2,17 @@
 Smart Rate Limit Cache Manager
 Caches database rate limits per API key with intelligent refresh logic
 """
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 import asyncio
-from dataclasses import dataclass
+from itertools import islice
+from dataclasses import dataclass, field
 from .db_access_control import get_client_api_access, ClientAPIAccess
+from .security_monitor import mask_key
 
-@dataclass
+@dataclass(slots=True)
 class CachedRateLimit:
-    """Cached rate limit configuration for an API key"""
+    """Cached rate limit configuration for an API key (slotted - one instance per cached key)"""
     api_key: str
     client_id: int
     access_tier: str
@@ -21,34 +23,57 @@ class CachedRateLimit:
     is_suspended: bool
     is_auto_blocked: bool
     override_all_limits: bool
+    burst_requests_allowed: int  # Extra requests on top of requests_per_minute (0/None - no burst)
     
     # Cache metadata
     cached_at: datetime
     last_refreshed: datetime
     refresh_count: int
     
-    def is_cache_expired(self, cache_ttl_minutes: int = 15) -> bool:
-        """Check if cache entry needs refresh"""
-        return datetime.now() - self.last_refreshed > timedelta(minutes=cache_ttl_minutes)
+    # Log-safe form of api_key, ISO timestamps and the effective limits, computed once per
+    # cache entry (a refresh replaces the whole entry, so none of them can go stale)
+    masked_key: str = field(init=False, repr=False, compare=False)
+    cached_at_iso: str = field(init=False, repr=False, compare=False)
+    last_refreshed_iso: str = field(init=False, repr=False, compare=False)
+    _rate_limits: Dict[str, int] = field(init=False, repr=False, compare=False)
+    # Effective limits as plain ints for the per-request check (same values as _rate_limits)
+    minute_limit: int = field(init=False, repr=False, compare=False)
+    hour_limit: int = field(init=False, repr=False, compare=False)
+    day_limit: int = field(init=False, repr=False, compare=False)
     
-    def should_force_refresh(self, force_refresh_threshold_minutes: int = 60) -> bool:
-        """Check if cache entry should be force refreshed (longer interval)"""
-        return datetime.now() - self.cached_at > timedelta(minutes=force_refresh_threshold_minutes)
-    
-    def get_rate_limits(self) -> Dict[str, int]:
-        """Get current rate limits from cache"""
+    def __post_init__(self):
+        self.masked_key = mask_key(self.api_key)
+        self.cached_at_iso = self.cached_at.isoformat()
+        self.last_refreshed_iso = self.last_refreshed.isoformat()
+        
         if self.override_all_limits:
-            return {
+            self._rate_limits = {
                 "requests_per_minute": 999999,
                 "requests_per_hour": 999999,
                 "requests_per_day": 999999
             }
+        else:
+            self._rate_limits = {
+                "requests_per_minute": self.requests_per_minute,
+                "requests_per_hour": self.requests_per_hour,
+                "requests_per_day": self.requests_per_day
+            }
         
-        return {
-            "requests_per_minute": self.requests_per_minute,
-            "requests_per_hour": self.requests_per_hour,
-            "requests_per_day": self.requests_per_day
-        }
+        self.minute_limit = self._rate_limits["requests_per_minute"]
+        self.hour_limit = self._rate_limits["requests_per_hour"]
+        self.day_limit = self._rate_limits["requests_per_day"]
+    
+    def is_cache_expired(self, cache_ttl_minutes: int = 15, now: Optional[datetime] = None) -> bool:
+        """Check if cache entry needs refresh (pass now to share one clock read per request)"""
+        return (now or datetime.now()) - self.last_refreshed > timedelta(minutes=cache_ttl_minutes)
+    
+    def should_force_refresh(self, force_refresh_threshold_minutes: int = 60, now: Optional[datetime] = None) -> bool:
+        """Check if cache entry should be force refreshed (longer interval)"""
+        return (now or datetime.now()) - self.cached_at > timedelta(minutes=force_refresh_threshold_minutes)
+    
+    def get_rate_limits(self) -> Dict[str, int]:
+        """Get current rate limits from cache (shared dict - do not mutate)"""
+        return self._rate_limits
     
     def is_account_valid(self) -> Tuple[bool, str]:
         """Validate account status from cache"""
@@ -98,12 +123,12 @@ class RateLimitCacheManager:
             cached_config = self._cache[api_key]
             
             # Check if cache is still fresh
-            if not cached_config.is_cache_expired(self.cache_ttl_minutes):
+            if not cached_config.is_cache_expired(self.cache_ttl_minutes, now):
                 self.cache_hits += 1
                 return cached_config
             
             # Cache expired but not too old - refresh in background if needed
-            if not cached_config.should_force_refresh(self.force_refresh_threshold_minutes):
+            if not cached_config.should_force_refresh(self.force_refresh_threshold_minutes, now):
                 # Use cached data while refreshing in background
                 asyncio.create_task(self._background_refresh(api_key))
                 self.cache_hits += 1
@@ -127,6 +152,7 @@ class RateLimitCacheManager:
                 is_suspended=client_access.is_suspended,
                 is_auto_blocked=client_access.is_auto_blocked,
                 override_all_limits=client_access.override_all_limits,
+                burst_requests_allowed=client_access.burst_requests_allowed,
                 cached_at=now,
                 last_refreshed=now,
                 refresh_count=1
@@ -173,6 +199,7 @@ class RateLimitCacheManager:
                     is_suspended=client_access.is_suspended,
                     is_auto_blocked=client_access.is_auto_blocked,
                     override_all_limits=client_access.override_all_limits,
+                    burst_requests_allowed=client_access.burst_requests_allowed,
                     cached_at=cached_config.cached_at,  # Keep original cache time
                     last_refreshed=now,
                     refresh_count=cached_config.refresh_count + 1
@@ -189,7 +216,7 @@ class RateLimitCacheManager:
         cleanup_threshold = now - timedelta(minutes=self.cleanup_interval_minutes * 2)
         
         keys_to_remove = [
-            key for key, cached_config in self._cache.items()
+            key for key, cached_config in self.snapshot()
             if cached_config.last_refreshed < cleanup_threshold
         ]
         
@@ -201,11 +228,60 @@ class RateLimitCacheManager:
         if keys_to_remove:
             print(f"Cache cleanup: Removed {len(keys_to_remove)} old entries")
     
+    def prime(self, client_access: ClientAPIAccess):
+        """
+        Store access configuration already read by another query (e.g. the fused account lookup),
+        so the next get_rate_limit_config() is a hit. A fresh entry is left as is.
+        """
+        api_key = client_access.api_key
+        now = datetime.now()
+        previous = self._cache.get(api_key)
+        if previous is not None and not previous.is_cache_expired(self.cache_ttl_minutes, now):
+            return
+        
+        self._cache[api_key] = CachedRateLimit(
+            api_key=client_access.api_key,
+            client_id=client_access.client_id,
+            access_tier=client_access.access_tier,
+            requests_per_minute=client_access.requests_per_minute,
+            requests_per_hour=client_access.requests_per_hour,
+            requests_per_day=client_access.requests_per_day,
+            is_active=client_access.is_active,
+            is_suspended=client_access.is_suspended,
+            is_auto_blocked=client_access.is_auto_blocked,
+            override_all_limits=client_access.override_all_limits,
+            burst_requests_allowed=client_access.burst_requests_allowed,
+            cached_at=previous.cached_at if previous else now,
+            last_refreshed=now,
+            refresh_count=previous.refresh_count + 1 if previous else 1
+        )
+        self.db_fetches += 1
+    
     def invalidate_cache(self, api_key: str):
         """Force invalidate cache for specific API key"""
         if api_key in self._cache:
             del self._cache[api_key]
     
+    def reset(self):
+        """
+        Drop every cached entry and reset statistics in one step.
+        Runs without awaiting, so other coroutines never observe a partially cleared cache.
+        """
+        self._cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.db_fetches = 0
+        self.last_cleanup = datetime.now()
+    
+    def snapshot(self, limit: Optional[int] = None, offset: int = 0) -> List[Tuple[str, CachedRateLimit]]:
+        """
+        Copy of the cache entries, safe to iterate while the cache keeps changing.
+        Pass limit/offset to copy only one page of entries.
+        """
+        if limit is None and not offset:
+            return list(self._cache.items())
+        return list(islice(self._cache.items(), offset, None if limit is None else offset + limit))
+    
     def get_cache_stats(self) -> Dict:
         """Get cache performance statistics"""
         total_requests = self.cache_hits + self.cache_misses
@@ -2,19 +2,118 @@
 Database Security Logger
 Stores security events in database for long-term tracking and analysis
 """
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
 from datetime import datetime
 from sqlalchemy import text
 from .db import get_engine
-import json
+import orjson
 import asyncio
 
+# Statements are built once at import and reused for every write
+_INSERT_SECURITY_EVENT_RETURNING_ID = text("""
+    INSERT INTO app.security_events (
+        event_type, event_timestamp, source_ip, api_key, client_id,
+        event_severity, event_description, event_data, action_taken,
+        endpoint, response_code, user_agent
+    )
+    OUTPUT INSERTED.event_id
+    VALUES (
+        :event_type, GETDATE(), :source_ip, :api_key, :client_id,
+        :event_severity, :event_description, :event_data, :action_taken,
+        :endpoint, :response_code, :user_agent
+    )
+""")
+
+_INSERT_SECURITY_EVENTS = text("""
+    INSERT INTO app.security_events (
+        event_type, event_timestamp, source_ip, api_key, client_id,
+        event_severity, event_description, event_data, action_taken,
+        endpoint, response_code, user_agent
+    )
+    VALUES (
+        :event_type, GETDATE(), :source_ip, :api_key, :client_id,
+        :event_severity, :event_description, :event_data, :action_taken,
+        :endpoint, :response_code, :user_agent
+    )
+""")
+
+_INSERT_RATE_LIMIT_VIOLATION = text("""
+    INSERT INTO app.rate_limit_violations (
+        api_key, client_id, source_ip, limit_type, limit_value, 
+        actual_requests, excess_requests, access_tier,
+        requests_per_minute, requests_per_hour, requests_per_day,
+        endpoint, user_agent, security_event_id
+    )
+    VALUES (
+        :api_key, :client_id, :source_ip, :limit_type, :limit_value,
+        :actual_requests, :excess_requests, :access_tier,
+        :requests_per_minute, :requests_per_hour, :requests_per_day,
+        :endpoint, :user_agent, :security_event_id
+    )
+""")
+
+_INSERT_IP_BLOCKING_EVENT = text("""
+    INSERT INTO app.ip_blocking_events (
+        ip_address, block_reason, block_type, requests_in_period,
+        time_period_minutes, total_requests_lifetime, first_seen_timestamp,
+        security_event_id
+    )
+    VALUES (
+        :ip_address, :block_reason, :block_type, :requests_in_period,
+        :time_period_minutes, :total_requests_lifetime, :first_seen_timestamp,
+        :security_event_id
+    )
+""")
+
+_INSERT_API_KEY_SECURITY_EVENT = text("""
+    INSERT INTO app.api_key_security_events (
+        api_key, client_id, event_type, event_description,
+        source_ip, endpoint, previous_status, new_status,
+        action_automatic, action_by
+    )
+    VALUES (
+        :api_key, :client_id, :event_type, :event_description,
+        :source_ip, :endpoint, :previous_status, :new_status,
+        :action_automatic, :action_by
+    )
+""")
+
+_MERGE_DAILY_STATISTICS = text("""
+    MERGE app.security_statistics_daily AS target
+    USING (
+        SELECT CAST(GETDATE() AS DATE) AS stat_date,
+               COUNT(*) AS total_events,
+               COUNT(CASE WHEN event_type = 'BRUTAL_ATTACK' THEN 1 END) AS brutal_attacks,
+               COUNT(CASE WHEN event_type = 'RATE_LIMIT_EXCEEDED' THEN 1 END) AS rate_limited_requests,
+               COUNT(CASE WHEN event_type = 'IP_BLOCKED' THEN 1 END) AS new_blocked_ips,
+               COUNT(DISTINCT source_ip) AS unique_ips
+        FROM app.security_events 
+        WHERE CAST(event_timestamp AS DATE) = CAST(GETDATE() AS DATE)
+    ) AS source ON target.stat_date = source.stat_date
+    WHEN MATCHED THEN
+        UPDATE SET 
+            brutal_attacks = source.brutal_attacks,
+            rate_limited_requests = source.rate_limited_requests,
+            new_blocked_ips = source.new_blocked_ips,
+            unique_ips = source.unique_ips,
+            updated_at = GETDATE()
+    WHEN NOT MATCHED THEN
+        INSERT (stat_date, brutal_attacks, rate_limited_requests, new_blocked_ips, unique_ips)
+        VALUES (source.stat_date, source.brutal_attacks, source.rate_limited_requests, source.new_blocked_ips, source.unique_ips);
+""")
+
 class SecurityEventLogger:
     """Database logger for security events"""
     
     def __init__(self):
         self.engine = get_engine()
     
+    def _execute(self, statement, params=None, scalar: bool = False):
+        """Run a statement in its own transaction (blocking - called through asyncio.to_thread)"""
+        with self.engine.begin() as conn:
+            result = conn.execute(statement, params)
+            return result.scalar() if scalar else None
+    
     async def log_security_event(
         self,
         event_type: str,
@@ -32,40 +131,57 @@ class SecurityEventLogger:
         """Log a security event to database"""
         
         try:
-            with self.engine.begin() as conn:
-                result = conn.execute(text("""
-                    INSERT INTO app.security_events (
-                        event_type, event_timestamp, source_ip, api_key, client_id,
-                        event_severity, event_description, event_data, action_taken,
-                        endpoint, response_code, user_agent
-                    )
-                    OUTPUT INSERTED.event_id
-                    VALUES (
-                        :event_type, GETDATE(), :source_ip, :api_key, :client_id,
-                        :event_severity, :event_description, :event_data, :action_taken,
-                        :endpoint, :response_code, :user_agent
-                    )
-                """), {
-                    "event_type": event_type,
-                    "source_ip": source_ip,
-                    "api_key": api_key,
-                    "client_id": client_id,
-                    "event_severity": event_severity,
-                    "event_description": event_description,
-                    "event_data": json.dumps(event_data) if event_data else None,
-                    "action_taken": action_taken,
-                    "endpoint": endpoint,
-                    "response_code": response_code,
-                    "user_agent": user_agent
-                })
-                
-                event_id = result.scalar()
-                return event_id
+            event_id = await asyncio.to_thread(self._execute, _INSERT_SECURITY_EVENT_RETURNING_ID, {
+                "event_type": event_type,
+                "source_ip": source_ip,
+                "api_key": api_key,
+                "client_id": client_id,
+                "event_severity": event_severity,
+                "event_description": event_description,
+                "event_data": orjson.dumps(event_data).decode() if event_data else None,
+                "action_taken": action_taken,
+                "endpoint": endpoint,
+                "response_code": response_code,
+                "user_agent": user_agent
+            }, scalar=True)
+            
+            return event_id
                 
         except Exception as e:
             print(f"Error logging security event: {e}")
             return None
     
+    async def log_security_events(self, events: List[Dict[str, Any]]) -> int:
+        """
+        Log a batch of security events to database with a single executemany.
+        Each event uses the keyword names of log_security_event. Returns the number of rows written.
+        """
+        if not events:
+            return 0
+        
+        try:
+            await asyncio.to_thread(self._execute, _INSERT_SECURITY_EVENTS, [
+                {
+                    "event_type": event["event_type"],
+                    "source_ip": event.get("source_ip"),
+                    "api_key": event.get("api_key"),
+                    "client_id": event.get("client_id"),
+                    "event_severity": event.get("event_severity", "MEDIUM"),
+                    "event_description": event["event_description"],
+                    "event_data": orjson.dumps(event["event_data"]).decode() if event.get("event_data") else None,
+                    "action_taken": event.get("action_taken"),
+                    "endpoint": event.get("endpoint"),
+                    "response_code": event.get("response_code"),
+                    "user_agent": event.get("user_agent")
+                }
+                for event in events
+            ])
+            return len(events)
+                
+        except Exception as e:
+            print(f"Error logging {len(events)} security events: {e}")
+            return 0
+    
     async def log_rate_limit_violation(
         self,
         api_key: str,
@@ -106,36 +222,22 @@ class SecurityEventLogger:
         
         # Then log the detailed rate limit violation
         try:
-            with self.engine.begin() as conn:
-                conn.execute(text("""
-                    INSERT INTO app.rate_limit_violations (
-                        api_key, client_id, source_ip, limit_type, limit_value, 
-                        actual_requests, excess_requests, access_tier,
-                        requests_per_minute, requests_per_hour, requests_per_day,
-                        endpoint, user_agent, security_event_id
-                    )
-                    VALUES (
-                        :api_key, :client_id, :source_ip, :limit_type, :limit_value,
-                        :actual_requests, :excess_requests, :access_tier,
-                        :requests_per_minute, :requests_per_hour, :requests_per_day,
-                        :endpoint, :user_agent, :security_event_id
-                    )
-                """), {
-                    "api_key": api_key,
-                    "client_id": client_id,
-                    "source_ip": source_ip,
-                    "limit_type": limit_type,
-                    "limit_value": limit_value,
-                    "actual_requests": actual_requests,
-                    "excess_requests": actual_requests - limit_value,
-                    "access_tier": access_tier,
-                    "requests_per_minute": requests_per_minute,
-                    "requests_per_hour": requests_per_hour,
-                    "requests_per_day": requests_per_day,
-                    "endpoint": endpoint,
-                    "user_agent": user_agent,
-                    "security_event_id": event_id
-                })
+            await asyncio.to_thread(self._execute, _INSERT_RATE_LIMIT_VIOLATION, {
+                "api_key": api_key,
+                "client_id": client_id,
+                "source_ip": source_ip,
+                "limit_type": limit_type,
+                "limit_value": limit_value,
+                "actual_requests": actual_requests,
+                "excess_requests": actual_requests - limit_value,
+                "access_tier": access_tier,
+                "requests_per_minute": requests_per_minute,
+                "requests_per_hour": requests_per_hour,
+                "requests_per_day": requests_per_day,
+                "endpoint": endpoint,
+                "user_agent": user_agent,
+                "security_event_id": event_id
+            })
                 
         except Exception as e:
             print(f"Error logging rate limit violation: {e}")
@@ -171,28 +273,16 @@ class SecurityEventLogger:
         
         # Then log the detailed IP blocking event
         try:
-            with self.engine.begin() as conn:
-                conn.execute(text("""
-                    INSERT INTO app.ip_blocking_events (
-                        ip_address, block_reason, block_type, requests_in_period,
-                        time_period_minutes, total_requests_lifetime, first_seen_timestamp,
-                        security_event_id
-                    )
-                    VALUES (
-                        :ip_address, :block_reason, :block_type, :requests_in_period,
-                        :time_period_minutes, :total_requests_lifetime, :first_seen_timestamp,
-                        :security_event_id
-                    )
-                """), {
-                    "ip_address": ip_address,
-                    "block_reason": block_reason,
-                    "block_type": block_type,
-                    "requests_in_period": requests_in_period,
-                    "time_period_minutes": time_period_minutes,
-                    "total_requests_lifetime": total_requests_lifetime,
-                    "first_seen_timestamp": first_seen_timestamp,
-                    "security_event_id": event_id
-                })
+            await asyncio.to_thread(self._execute, _INSERT_IP_BLOCKING_EVENT, {
+                "ip_address": ip_address,
+                "block_reason": block_reason,
+                "block_type": block_type,
+                "requests_in_period": requests_in_period,
+                "time_period_minutes": time_period_minutes,
+                "total_requests_lifetime": total_requests_lifetime,
+                "first_seen_timestamp": first_seen_timestamp,
+                "security_event_id": event_id
+            })
                 
         except Exception as e:
             print(f"Error logging IP block event: {e}")
@@ -215,30 +305,18 @@ class SecurityEventLogger:
         """Log API key security event to database"""
         
         try:
-            with self.engine.begin() as conn:
-                conn.execute(text("""
-                    INSERT INTO app.api_key_security_events (
-                        api_key, client_id, event_type, event_description,
-                        source_ip, endpoint, previous_status, new_status,
-                        action_automatic, action_by
-                    )
-                    VALUES (
-                        :api_key, :client_id, :event_type, :event_description,
-                        :source_ip, :endpoint, :previous_status, :new_status,
-                        :action_automatic, :action_by
-                    )
-                """), {
-                    "api_key": api_key,
-                    "client_id": client_id,
-                    "event_type": event_type,
-                    "event_description": event_description,
-                    "source_ip": source_ip,
-                    "endpoint": endpoint,
-                    "previous_status": previous_status,
-                    "new_status": new_status,
-                    "action_automatic": action_automatic,
-                    "action_by": action_by
-                })
+            await asyncio.to_thread(self._execute, _INSERT_API_KEY_SECURITY_EVENT, {
+                "api_key": api_key,
+                "client_id": client_id,
+                "event_type": event_type,
+                "event_description": event_description,
+                "source_ip": source_ip,
+                "endpoint": endpoint,
+                "previous_status": previous_status,
+                "new_status": new_status,
+                "action_automatic": action_automatic,
+                "action_by": action_by
+            })
                 
         except Exception as e:
             print(f"Error logging API key security event: {e}")
@@ -246,30 +324,7 @@ class SecurityEventLogger:
     async def update_daily_statistics(self):
         """Update daily security statistics"""
         try:
-            with self.engine.begin() as conn:
-                conn.execute(text("""
-                    MERGE app.security_statistics_daily AS target
-                    USING (
-                        SELECT CAST(GETDATE() AS DATE) AS stat_date,
-                               COUNT(*) AS total_events,
-                               COUNT(CASE WHEN event_type = 'BRUTAL_ATTACK' THEN 1 END) AS brutal_attacks,
-                               COUNT(CASE WHEN event_type = 'RATE_LIMIT_EXCEEDED' THEN 1 END) AS rate_limited_requests,
-                               COUNT(CASE WHEN event_type = 'IP_BLOCKED' THEN 1 END) AS new_blocked_ips,
-                               COUNT(DISTINCT source_ip) AS unique_ips
-                        FROM app.security_events 
-                        WHERE CAST(event_timestamp AS DATE) = CAST(GETDATE() AS DATE)
-                    ) AS source ON target.stat_date = source.stat_date
-                    WHEN MATCHED THEN
-                        UPDATE SET 
-                            brutal_attacks = source.brutal_attacks,
-                            rate_limited_requests = source.rate_limited_requests,
-                            new_blocked_ips = source.new_blocked_ips,
-                            unique_ips = source.unique_ips,
-                            updated_at = GETDATE()
-                    WHEN NOT MATCHED THEN
-                        INSERT (stat_date, brutal_attacks, rate_limited_requests, new_blocked_ips, unique_ips)
-                        VALUES (source.stat_date, source.brutal_attacks, source.rate_limited_requests, source.new_blocked_ips, source.unique_ips);
-                """))
+            await asyncio.to_thread(self._execute, _MERGE_DAILY_STATISTICS)
                 
         except Exception as e:
             print(f"Error updating daily statistics: {e}")
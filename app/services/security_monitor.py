@@ -2,7 +2,10 @@
 API monitoring and security logging
 """
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
+from functools import lru_cache
 from typing import Dict, Any
 import json
 import os
@@ -19,6 +22,18 @@ logging.basicConfig(
 
 security_logger = logging.getLogger('security')
 
+# Security records are handed to a listener thread, so attack bursts never do file I/O on the event loop
+_security_log_queue = queue.Queue(-1)
+security_log_listener = QueueListener(_security_log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+security_logger.addHandler(QueueHandler(_security_log_queue))
+security_logger.propagate = False
+security_log_listener.start()
+
+@lru_cache(maxsize=4096)
+def mask_key(api_key: str) -> str:
+    """Partial API key for logs - the same few keys are masked on every request, so memoize"""
+    return api_key[:8] + "..." if len(api_key) > 8 else api_key
+
 class SecurityMonitor:
     def __init__(self):
         self.alerts_enabled = os.getenv("ENABLE_SECURITY_ALERTS", "true").lower() == "true"
@@ -52,7 +67,7 @@ class SecurityMonitor:
         log_entry = {
             "timestamp": datetime.now().isoformat(),
             "event_type": "API_USAGE",
-            "api_key": api_key[:8] + "..." if api_key else None,  # Masked for privacy
+            "api_key": mask_key(api_key) if api_key else None,  # Masked for privacy
             "endpoint": endpoint,
             "ip_address": ip,
             "response_code": response_code,
@@ -67,7 +82,7 @@ class SecurityMonitor:
             "RATE_LIMIT_EXCEEDED",
             ip,
             {
-                "api_key": api_key[:8] + "..." if api_key else None,
+                "api_key": mask_key(api_key) if api_key else None,
                 "limit_type": limit_type,
                 "action": "REQUEST_BLOCKED"
             }
@@ -79,7 +94,7 @@ class SecurityMonitor:
             "AUTH_FAILURE",
             ip,
             {
-                "attempted_key": attempted_key[:8] + "..." if attempted_key else None,
+                "attempted_key": mask_key(attempted_key) if attempted_key else None,
                 "action": "ACCESS_DENIED"
             }
         )
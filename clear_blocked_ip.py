@@ -15,8 +15,7 @@ def clear_blocked_ip(ip_address: str):
     print(f"Clearing blocked IP: {ip_address}")
     
     # Remove from tracking
-    if ip_address in ip_brutal_tracker._ip_tracking:
-        del ip_brutal_tracker._ip_tracking[ip_address]
+    if ip_brutal_tracker.forget_ip(ip_address):
         print(f"  ✓ Removed {ip_address} from tracking")
     else:
         print(f"  ℹ {ip_address} was not in tracking")
@@ -35,7 +34,7 @@ def clear_all_blocked_ips():
     print("Clearing all blocked IPs...")
     
     # Clear all IP tracking
-    ip_brutal_tracker._ip_tracking.clear()
+    ip_brutal_tracker.reset()
     
     try:
         ip_brutal_tracker.save_blocked_ips_to_file()
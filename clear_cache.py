@@ -53,6 +53,8 @@ def clear_all_caches():
     print("• Restart the FastAPI server (uvicorn)")
     print("• Or call the API endpoints to trigger cache refresh")
     print("• The rate limit cache will refresh automatically in 5 minutes")
+    print("• Resolved API keys are cached for 5 minutes - after revoking a key, call")
+    print("  app.services.auth.clear_client_id_cache(api_key) in the server process to drop it now")
     
     print("\n🎉 Cache clearing completed!")
     print("All persistent cache files have been cleared.")
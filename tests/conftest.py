@@ -0,0 +1,36 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+
+from app.services import db
+
+# Some services open the engine at import time; point them at an in-memory database
+# instead of the db_config.json / api_db_conn SQL Server used by the app
+db._engine = create_engine("sqlite://")
+
+
+@pytest.fixture
+def make_cached_config():
+    from app.services.rate_limit_cache import CachedRateLimit
+
+    def make(api_key="test_key_0001", per_minute=60, per_hour=1000, per_day=10000, burst=0):
+        now = datetime.now()
+        return CachedRateLimit(
+            api_key=api_key,
+            client_id=1,
+            access_tier="standard",
+            requests_per_minute=per_minute,
+            requests_per_hour=per_hour,
+            requests_per_day=per_day,
+            is_active=True,
+            is_suspended=False,
+            is_auto_blocked=False,
+            override_all_limits=False,
+            burst_requests_allowed=burst,
+            cached_at=now,
+            last_refreshed=now,
+            refresh_count=0,
+        )
+
+    return make
@@ -0,0 +1,41 @@
+from app.middleware.client_ip import client_ip_from_scope
+
+
+def _scope(headers, client=("198.51.100.1", 40000)):
+    return {"type": "http", "headers": headers, "client": client}
+
+
+def test_first_forwarded_for_header_and_hop_win():
+    scope = _scope([
+        (b"x-real-ip", b"192.0.2.9"),
+        (b"x-forwarded-for", b" 203.0.113.5 , 10.0.0.1"),
+        (b"x-forwarded-for", b"203.0.113.99"),
+    ])
+
+    assert client_ip_from_scope(scope) == "203.0.113.5"
+
+
+def test_first_real_ip_header_wins_without_forwarded_for():
+    scope = _scope([(b"x-real-ip", b"192.0.2.9"), (b"x-real-ip", b"192.0.2.10")])
+
+    assert client_ip_from_scope(scope) == "192.0.2.9"
+
+
+def test_falls_back_to_connection_address_and_caches_on_state():
+    scope = _scope([])
+
+    assert client_ip_from_scope(scope) == "198.51.100.1"
+    assert scope["state"]["client_ip"] == "198.51.100.1"
+
+    scope["headers"].append((b"x-forwarded-for", b"203.0.113.5"))
+    assert client_ip_from_scope(scope) == "198.51.100.1"
+
+
+def test_header_values_decode_as_latin1():
+    scope = _scope([(b"x-forwarded-for", "caf\xe9".encode("latin-1"))])
+
+    assert client_ip_from_scope(scope) == "caf\xe9"
+
+
+def test_unknown_without_headers_or_client():
+    assert client_ip_from_scope(_scope([], client=None)) == "unknown"
@@ -0,0 +1,24 @@
+import pytest
+
+from app.services import comprehensive_protection
+from app.services.comprehensive_protection import check_rate_limits_from_cache
+
+
+@pytest.fixture(autouse=True)
+def _empty_windows():
+    comprehensive_protection.usage_windows.clear()
+    yield
+    comprehensive_protection.usage_windows.clear()
+
+
+@pytest.mark.parametrize("limits", [
+    dict(per_minute=0),
+    dict(per_hour=0),
+    dict(per_day=0),
+])
+def test_zero_limit_rejects_first_request(make_cached_config, limits):
+    allowed, message = check_rate_limits_from_cache(make_cached_config(**limits))
+
+    assert not allowed
+    assert message.startswith("Rate limit exceeded: 0 requests per")
+
@@ -0,0 +1,33 @@
+import pytest
+
+from app.services import db_quota_manager
+from app.services.db_quota_manager import _minute_bucket
+
+
+@pytest.fixture(autouse=True)
+def _empty_buckets():
+    db_quota_manager.minute_buckets.clear()
+    yield
+    db_quota_manager.minute_buckets.clear()
+
+
+def test_burst_adds_to_minute_limit(make_cached_config):
+    bucket = _minute_bucket(make_cached_config(per_minute=10, burst=3), now=0.0)
+
+    assert bucket.cap == 13
+    assert bucket.tokens == 13
+
+
+def test_no_burst_caps_at_minute_limit(make_cached_config):
+    bucket = _minute_bucket(make_cached_config(per_minute=10, burst=None), now=0.0)
+
+    assert bucket.cap == 10
+
+
+def test_refill_stops_at_minute_limit_plus_burst(make_cached_config):
+    config = make_cached_config(per_minute=60, burst=5)
+    bucket = _minute_bucket(config, now=0.0)
+    bucket.tokens = 0
+
+    assert _minute_bucket(config, now=10.0).tokens == 10
+    assert _minute_bucket(config, now=120.0).tokens == 65
@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+import pytest
+
+from app.middleware.ip_blocking import IPBlockingMiddleware, flush_blocked_ips
+
+
+def _scope():
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": "/stream",
+        "query_string": b"",
+        "headers": [],
+        "client": ("203.0.113.7", 50000),
+    }
+
+
+async def _call(app, timeout):
+    middleware = IPBlockingMiddleware(app, request_timeout=timeout)
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    try:
+        await middleware(_scope(), receive, send)
+    finally:
+        middleware._writer_task.cancel()
+    return sent
+
+
+@pytest.fixture(autouse=True)
+def _isolated_block_list(tmp_path, monkeypatch):
+    # The middleware loads and saves blocked_ips.json in the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def test_streamed_response_outlives_timeout():
+    async def streaming_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        for chunk in (b"a", b"b", b"c"):
+            await asyncio.sleep(0.1)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    sent = asyncio.run(_call(streaming_app, timeout=0.15))
+
+    assert sent[0]["status"] == 200
+    assert b"".join(m.get("body", b"") for m in sent[1:]) == b"abc"
+    assert sent[-1]["more_body"] is False
+
+
+def test_no_response_within_timeout_is_408():
+    async def stalled_app(scope, receive, send):
+        await asyncio.sleep(10)
+
+    sent = asyncio.run(_call(stalled_app, timeout=0.05))
+
+    assert sent[0]["status"] == 408
+
+
+def test_flush_writes_debounced_block_list():
+    async def scenario():
+        middleware = IPBlockingMiddleware(None)
+        middleware._writer_task = asyncio.create_task(middleware._blocked_ips_writer())
+        middleware.block_ip("203.0.113.50")
+        await flush_blocked_ips()
+        return middleware
+
+    middleware = asyncio.run(scenario())
+
+    with open("blocked_ips.json") as f:
+        assert json.load(f)["ips"] == ["203.0.113.50"]
+    assert middleware._writer_task is None